@@ -32,59 +32,43 @@ __revision__ = '$Format:%H$'
 
 import datetime
 import json
-import math
 import os
+from collections import deque
 from . import resources
+from .DeepForestPlugin_cache import TileCache
+from .DeepForestPlugin_client import AsyncTreeDetectorClient, DetectorError, TreeDetectorClient, split_urls
+from .DeepForestPlugin_codecs import CODECS, make_codec
+from .DeepForestPlugin_detections import (boxes_to_columns, concat_columns, envelope, extent_geotransform,
+                                          merge_overlapping, overlap_duplicates,
+                                          save_raw_detections, take_rows)
+from .DeepForestPlugin_journal import TileJournal
+from .DeepForestPlugin_merge import SeamMerger
+from .DeepForestPlugin_pipeline import BatchSizer, TilePipeline, batched, run_ordered, unbatch
+from .DeepForestPlugin_reader import TileReader, VEGETATION_INDICES
+from .DeepForestPlugin_writers import FeatureSinkWriter, GeoJsonWriter, GeoParquetWriter
 
 import numpy as np
-import requests
-from PIL import Image
 from osgeo import gdal
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.PyQt.QtGui import QIcon
-from qgis.core import (QgsProcessingAlgorithm,
+from qgis.core import (QgsApplication,
+                       QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingException,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterFolderDestination,
                        QgsProcessingParameterNumber,
-                       QgsRasterLayer)
+                       QgsProcessingParameterString,
+                       QgsRasterLayer,
+                       QgsWkbTypes)
 
 
 # https://www.qgistutorials.com/en/docs/3/processing_python_plugin.html
 # https://docs.qgis.org/3.22/en/docs/pyqgis_developer_cookbook/cheat_sheet.html#layers
-def overlap(rect_1, rect_2):
-    r1_right = max(rect_1['xg_0'], rect_1['xg_1'])
-    r1_left = min(rect_1['xg_0'], rect_1['xg_1'])
-    r1_top = max(rect_1['yg_0'], rect_1['yg_1'])
-    r1_bottom = min(rect_1['yg_0'], rect_1['yg_1'])
-
-    r1_mx = (r1_left + r1_right) / 2
-    r1_my = (r1_bottom + r1_top) / 2
-
-    r2_right = max(rect_2['xg_0'], rect_2['xg_1'])
-    r2_left = min(rect_2['xg_0'], rect_2['xg_1'])
-    r2_top = max(rect_2['yg_0'], rect_2['yg_1'])
-    r2_bottom = min(rect_2['yg_0'], rect_2['yg_1'])
-
-    r2_mx = (r2_left + r2_right) / 2
-    r2_my = (r2_bottom + r2_top) / 2
-
-    if r1_left <= r2_mx <= r1_right and r1_bottom <= r2_my <= r1_top:
-        return True
-    if r2_left <= r1_mx <= r2_right and r2_bottom <= r1_my <= r2_top:
-        return True
-
-    return False
-
-
-def get_area(rect_1):
-    r1_right = max(rect_1['xg_0'], rect_1['xg_1'])
-    r1_left = min(rect_1['xg_0'], rect_1['xg_1'])
-    r1_top = max(rect_1['yg_0'], rect_1['yg_1'])
-    r1_bottom = min(rect_1['yg_0'], rect_1['yg_1'])
-
-    return (r1_right - r1_left) * (r1_top - r1_bottom)
-
-
 class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
     """
     All Processing algorithms should extend the QgsProcessingAlgorithm
@@ -96,6 +80,7 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
     # calling from the QGIS console.
 
     OUTPUT = 'OUTPUT'
+    OUTPUT_TREES = 'OUTPUT_TREES'
     INPUT = 'INPUT'
     INPUT_LIMIT = 'INPUT_LIMIT'
     INPUT_TILE_SLICE = 'INPUT_TILE'
@@ -103,10 +88,36 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
     INPUT_OVERLAP = 'INPUT_PATCH_OVERLAP'
     INPUT_THRESH = 'INPUT_THRESH'
     INPUT_IOU_THRESH = 'INPUT_IOU_THRESH'
+    INPUT_BLOCK_ALIGN = 'INPUT_BLOCK_ALIGN'
+    INPUT_MIN_VALID = 'INPUT_MIN_VALID'
+    INPUT_VEG_INDEX = 'INPUT_VEG_INDEX'
+    INPUT_VEG_THRESH = 'INPUT_VEG_THRESH'
+    INPUT_VEG_FRACTION = 'INPUT_VEG_FRACTION'
+    INPUT_CODEC = 'INPUT_CODEC'
+    INPUT_CODEC_QUALITY = 'INPUT_CODEC_QUALITY'
+    INPUT_CODEC_OPTIMIZE = 'INPUT_CODEC_OPTIMIZE'
+    INPUT_WORKERS = 'INPUT_WORKERS'
+    INPUT_ENCODERS = 'INPUT_ENCODERS'
+    INPUT_TRANSPORT = 'INPUT_TRANSPORT'
+    INPUT_SERVERS = 'INPUT_SERVERS'
+    INPUT_BATCH = 'INPUT_BATCH'
+    INPUT_TIMEOUT = 'INPUT_TIMEOUT'
+    INPUT_RETRIES = 'INPUT_RETRIES'
+    INPUT_RESUME = 'INPUT_RESUME'
+    INPUT_CACHE_SIZE = 'INPUT_CACHE_SIZE'
+    INPUT_RAW_FLOOR = 'INPUT_RAW_FLOOR'
+    INPUT_MERGE = 'INPUT_MERGE'
+    INPUT_FORMAT = 'INPUT_FORMAT'
+
+    TRANSPORTS = ['Threads', 'asyncio']
+    MERGES = ['Non-maximum suppression', 'Weighted box fusion', 'Centre in box']
+    FORMATS = ['GeoJSON', 'GeoJSONSeq', 'GeoParquet']
+    FORMAT_EXTENSIONS = {'GeoJSON': 'geojson', 'GeoJSONSeq': 'geojsonl', 'GeoParquet': 'parquet'}
 
     MSG_SRC = 'DeepForestPluginAlgorithm'
     MSG_INFO = 0
     BASE_URL = 'http://10.125.93.137:5000/'
+    BATCH_MEMORY = 512 * 1024 * 1024  # bytes of slices that may be in flight in batches
 
     def initAlgorithm(self, config):
         """
@@ -207,6 +218,337 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
             'Lower values suppress more boxes at edges.' +
             'Defaults to 0.5')
 
+        # Add merge method for trees found in more than one slice
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_MERGE,
+                self.tr('Merging of overlapping trees'),
+                options=self.MERGES,
+                defaultValue=0,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_MERGE).setHelp(
+            'How boxes of the same tree found in neighbouring slices are merged. ' +
+            'Non-maximum suppression keeps the box with the highest score of boxes that overlap more than ' +
+            'the overlap detection threshold. Weighted box fusion averages them instead, weighted by score. ' +
+            'Centre in box removes the smaller of two boxes when the centre of one lies in the other, ' +
+            'regardless of score and threshold, as earlier versions did. ' +
+            'Defaults to Non-maximum suppression')
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_FORMAT,
+                self.tr('Output format'),
+                options=self.FORMATS,
+                defaultValue=0,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_FORMAT).setHelp(
+            'GeoJSON writes a trees_*.geojson FeatureCollection. ' +
+            'GeoJSONSeq writes a trees_*.geojsonl file with one tree per line as soon as it is final, ' +
+            'so the file can be followed while the job runs. GeoJSONSeq has no CRS, ' +
+            'it is recorded in the settings file instead. ' +
+            'GeoParquet writes a trees_*.parquet file with the polygon, bounding box, centroid, score, label, ' +
+            'slice and tree of every tree, for loading into columnar engines; it needs the pyarrow package. ' +
+            'Defaults to GeoJSON')
+
+        # Add block alignment parameter for slicing
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INPUT_BLOCK_ALIGN,
+                self.tr('Align slices to raster blocks'),
+                defaultValue=False,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_BLOCK_ALIGN).setHelp(
+            'Snap the slice grid (and overlap, where possible) to whole blocks of the raster. ' +
+            'Speeds up reading tiled GeoTIFFs, since no block is decompressed more than needed. ' +
+            'Defaults to False')
+
+        # Add minimum valid fraction parameter for skipping empty slices
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_MIN_VALID,
+                self.tr('Minimum valid pixel fraction'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.01,
+                optional=True,
+                minValue=0.0,
+                maxValue=1.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_MIN_VALID).setHelp(
+            'Slices with a smaller fraction of valid pixels (not nodata, not transparent) are skipped ' +
+            'and never sent to the tree detector. Set to 0 to process every slice. ' +
+            'Defaults to 0.01')
+
+        # Add vegetation pre-screen parameters
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_VEG_INDEX,
+                self.tr('Vegetation index for pre-screening'),
+                options=list(VEGETATION_INDICES),
+                defaultValue=0,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_VEG_INDEX).setHelp(
+            'The RGB vegetation index used to pre-screen slices for trees: ' +
+            'Excess Green (ExG), Green Leaf Index (GLI) or VARI. ' +
+            'Defaults to ExG')
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_VEG_THRESH,
+                self.tr('Vegetation index threshold'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.05,
+                optional=True,
+                minValue=-1.0,
+                maxValue=2.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_VEG_THRESH).setHelp(
+            'Pixels with a vegetation index above this value count as vegetation. ' +
+            'Defaults to 0.05')
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_VEG_FRACTION,
+                self.tr('Minimum vegetation fraction'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                optional=True,
+                minValue=0.0,
+                maxValue=1.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_VEG_FRACTION).setHelp(
+            'Slices with a smaller fraction of vegetation pixels are considered treeless ' +
+            'and never sent to the tree detector. Set to 0 to disable the pre-screen. ' +
+            'Defaults to 0')
+
+        # Add inference servers parameter
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.INPUT_SERVERS,
+                self.tr('Tree detection servers'),
+                defaultValue=self.BASE_URL,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_SERVERS).setHelp(
+            'Base urls of one or more DeepForest web services, separated by commas. ' +
+            'Slices are spread over the servers, slow or failing servers are skipped for a while. ' +
+            'Defaults to ' + self.BASE_URL)
+
+        # Add batch size parameter
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_BATCH,
+                self.tr('Slices per request'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                optional=True,
+                minValue=0,
+                maxValue=32,
+            )
+        )
+        self.parameterDefinition(self.INPUT_BATCH).setHelp(
+            'Number of slices sent to the tree detector in a single request, which saves a round trip ' +
+            'per slice when slices are small. Needs a server with a tree_rects_batch endpoint, ' +
+            'otherwise slices are sent one by one. ' +
+            'Set to 0 to size batches from the measured overhead per request. ' +
+            'Defaults to 1')
+
+        # Add failure recovery parameters
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_TIMEOUT,
+                self.tr('Request timeout (seconds)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=300.0,
+                optional=True,
+                minValue=0.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_TIMEOUT).setHelp(
+            'How long to wait for the tree detector to answer a request before trying another server. ' +
+            'Set to 0 to wait forever. ' +
+            'Defaults to 300')
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_RETRIES,
+                self.tr('Retries per request'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=3,
+                optional=True,
+                minValue=0,
+                maxValue=10,
+            )
+        )
+        self.parameterDefinition(self.INPUT_RETRIES).setHelp(
+            'How many more times a request is tried, with a growing pause in between, after every server ' +
+            'failed it. Slices that still fail are tried once more at the end of the run; ' +
+            'the ones that are missing after that are listed in the settings file. ' +
+            'Defaults to 3')
+
+        # Add resume parameter
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INPUT_RESUME,
+                self.tr('Resume an interrupted run'),
+                defaultValue=False,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_RESUME).setHelp(
+            'Finished slices are written to a journal file in the destination folder as the run goes. ' +
+            'When set, the slices in the journal of an earlier run with the same raster and settings ' +
+            'are not sent again, so a cancelled or crashed run continues where it stopped. ' +
+            'Defaults to False')
+
+        # Add result cache parameter
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_CACHE_SIZE,
+                self.tr('Result cache size (MB)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=256,
+                optional=True,
+                minValue=0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_CACHE_SIZE).setHelp(
+            'The boxes of every slice are cached in the QGIS profile folder, by the pixels of the slice, ' +
+            'the detection settings, the model version of the servers and the slice encoding. ' +
+            'Slices that are in the cache are not sent again, e.g. when running on the same raster twice. ' +
+            'The cache is not used when a server does not report its model version. ' +
+            'The least recently used results are removed when the cache grows over this size. ' +
+            'Set to 0 to disable the cache. ' +
+            'Defaults to 256')
+
+        # Add raw detections parameter
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_RAW_FLOOR,
+                self.tr('Store raw detections down to this score'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                optional=True,
+                minValue=0.0,
+                maxValue=0.95,
+            )
+        )
+        self.parameterDefinition(self.INPUT_RAW_FLOOR).setHelp(
+            'When set, the tree detector is asked for all boxes down to this score, and they are stored ' +
+            'with their scores in a detections_*.npz file next to the output. ' +
+            'The output itself still only has the trees above the tree detection threshold. ' +
+            'Use the Refilter Trees algorithm on the stored detections to try other thresholds ' +
+            'without detecting again. Set to 0 to not store raw detections. ' +
+            'Defaults to 0')
+
+        # Add tile encoding parameters
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_CODEC,
+                self.tr('Slice encoding'),
+                options=[codec.name for codec in CODECS],
+                defaultValue=0,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_CODEC).setHelp(
+            'How slices are encoded before they are uploaded to the tree detector. ' +
+            'Lossy formats are smaller on the wire, lossless formats are faster to encode. ' +
+            'Raw and NPY need a server that accepts them. ' +
+            'Defaults to JPEG')
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_CODEC_QUALITY,
+                self.tr('Slice encoding quality'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=90,
+                optional=True,
+                minValue=1,
+                maxValue=100,
+            )
+        )
+        self.parameterDefinition(self.INPUT_CODEC_QUALITY).setHelp(
+            'Quality of the lossy slice encodings (JPEG and WebP). ' +
+            'Defaults to 90')
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INPUT_CODEC_OPTIMIZE,
+                self.tr('Optimize slice encoding'),
+                defaultValue=True,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_CODEC_OPTIMIZE).setHelp(
+            'Spend more time encoding to make slices a bit smaller. ' +
+            'Turn off when the connection to the server is fast. ' +
+            'Defaults to True')
+
+        # Add concurrency parameter for uploading slices
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_WORKERS,
+                self.tr('Concurrent requests'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                optional=True,
+                minValue=1,
+                maxValue=256,
+            )
+        )
+        self.parameterDefinition(self.INPUT_WORKERS).setHelp(
+            'Number of slices that are encoded and sent to the tree detector at the same time. ' +
+            'Higher values keep the server busy while slices are being prepared. ' +
+            'Use the asyncio transport for values above 32. ' +
+            'Defaults to 1')
+
+        # Add HTTP transport parameter
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_TRANSPORT,
+                self.tr('HTTP transport'),
+                options=self.TRANSPORTS,
+                defaultValue=0,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.INPUT_TRANSPORT).setHelp(
+            'Threads send every request from its own thread with the requests library. ' +
+            'asyncio sends all requests from a single event loop over kept-alive connections, ' +
+            'which scales better to many concurrent requests for large jobs. ' +
+            'Defaults to Threads')
+
+        # Add encoder processes parameter for the read/encode/upload pipeline
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_ENCODERS,
+                self.tr('Encoder processes'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                optional=True,
+                minValue=0,
+                maxValue=32,
+            )
+        )
+        self.parameterDefinition(self.INPUT_ENCODERS).setHelp(
+            'When set, reading, encoding and uploading slices run as separate stages at the same time, ' +
+            'with slices encoded in this many processes and uploaded by the concurrent requests. ' +
+            'Statistics per stage are written to the settings file. ' +
+            'Set to 0 to encode slices on the request threads. ' +
+            'Defaults to 0')
+
         # Output parameter is a folder on the users computer
         self.addParameter(
             QgsProcessingParameterFolderDestination(
@@ -219,6 +561,27 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
             'The generated GeoJSON will be placed in this folder after processing' +
             'Make sure this folder is writable.')
 
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT_TREES,
+                self.tr('Trees'),
+                type=QgsProcessing.TypeVectorPolygon,
+                optional=True,
+            )
+        )
+        self.parameterDefinition(self.OUTPUT_TREES).setHelp(
+            'The trees are also written to this layer while the slices finish, e.g. a GeoPackage or ' +
+            'FlatGeobuf file, which get a spatial index. The layer is returned as an output, ' +
+            'so it can be used directly in models. ' +
+            'Defaults to a temporary layer')
+
+        # tuning options go under Advanced Parameters, to keep the dialog usable
+        for name in (self.INPUT_CODEC_QUALITY, self.INPUT_CODEC_OPTIMIZE, self.INPUT_ENCODERS,
+                     self.INPUT_TRANSPORT, self.INPUT_BATCH, self.INPUT_TIMEOUT, self.INPUT_RETRIES,
+                     self.INPUT_CACHE_SIZE, self.INPUT_RAW_FLOOR):
+            definition = self.parameterDefinition(name)
+            definition.setFlags(definition.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
     # https://github.com/geoscan/geoscan_forest
     # https://bitbucket.org/kul-reseco/localmaxfilter/src/master/localmaxfilter/interfaces/localmaxfilter_processing.py
     # https://gis.stackexchange.com/questions/282773/writing-a-python-processing-script-with-qgis-3-0
@@ -227,9 +590,6 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
         feedback.pushInfo('Processing started')
         feedback.setProgress(0)
 
-        session = requests.Session()
-        session.headers.update({'Accept': 'application/json'})
-
         # get parameters
         source_layer = self.parameterAsRasterLayer(parameters, self.INPUT, context)
         dest_folder = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
@@ -238,205 +598,412 @@ class DeepForestPluginAlgorithm(QgsProcessingAlgorithm):
         i_patch_overlap = self.parameterAsDouble(parameters, self.INPUT_OVERLAP, context)
         i_thresh = self.parameterAsDouble(parameters, self.INPUT_THRESH, context)
         i_iou_thresh = self.parameterAsDouble(parameters, self.INPUT_IOU_THRESH, context)
-
-        settings = {}
-        if i_patch_size is not None:
-            settings['patch_size'] = i_patch_size
-        if i_patch_overlap is not None:
-            settings['patch_overlap'] = i_patch_overlap
-        if i_thresh is not None:
-            settings['thresh'] = i_thresh
-        if i_iou_thresh is not None:
-            settings['iou_threshold'] = i_iou_thresh
-        if bool(settings):
-            headers = {'Content-Type': 'application/json'}
-            resp = session.post(self.BASE_URL + 'settings',
-                                headers=headers,
-                                data=json.dumps(settings),
-                                cookies={'session': 'deepforest_plugin'})
-            if resp.status_code == 200:
-                feedback.pushInfo('Applied custom settings: {}'.format(settings))
+        i_block_align = self.parameterAsBool(parameters, self.INPUT_BLOCK_ALIGN, context)
+        i_min_valid = self.parameterAsDouble(parameters, self.INPUT_MIN_VALID, context)
+        i_veg_index = list(VEGETATION_INDICES)[self.parameterAsEnum(parameters, self.INPUT_VEG_INDEX, context)]
+        i_veg_thresh = self.parameterAsDouble(parameters, self.INPUT_VEG_THRESH, context)
+        i_veg_fraction = self.parameterAsDouble(parameters, self.INPUT_VEG_FRACTION, context)
+        i_codec = CODECS[self.parameterAsEnum(parameters, self.INPUT_CODEC, context)].name
+        i_codec_quality = self.parameterAsInt(parameters, self.INPUT_CODEC_QUALITY, context)
+        i_codec_optimize = self.parameterAsBool(parameters, self.INPUT_CODEC_OPTIMIZE, context)
+        i_workers = self.parameterAsInt(parameters, self.INPUT_WORKERS, context)
+        i_encoders = self.parameterAsInt(parameters, self.INPUT_ENCODERS, context)
+        i_transport = self.TRANSPORTS[self.parameterAsEnum(parameters, self.INPUT_TRANSPORT, context)]
+        i_batch = self.parameterAsInt(parameters, self.INPUT_BATCH, context)
+        i_servers = split_urls(self.parameterAsString(parameters, self.INPUT_SERVERS, context)) or [self.BASE_URL]
+        i_timeout = self.parameterAsDouble(parameters, self.INPUT_TIMEOUT, context) or None
+        i_retries = self.parameterAsInt(parameters, self.INPUT_RETRIES, context)
+        i_resume = self.parameterAsBool(parameters, self.INPUT_RESUME, context)
+        i_cache_size = self.parameterAsInt(parameters, self.INPUT_CACHE_SIZE, context)
+        i_raw_floor = self.parameterAsDouble(parameters, self.INPUT_RAW_FLOOR, context)
+        i_merge = self.MERGES[self.parameterAsEnum(parameters, self.INPUT_MERGE, context)]
+        i_format = self.FORMATS[self.parameterAsEnum(parameters, self.INPUT_FORMAT, context)]
+        if i_format == 'GeoParquet':
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise QgsProcessingException('GeoParquet output needs pyarrow, install it with pip install pyarrow')
+
+        if i_transport == 'asyncio':
+            client = AsyncTreeDetectorClient(i_servers, max_in_flight=i_workers, timeout=i_timeout,
+                                             retries=i_retries)
+        else:
+            client = TreeDetectorClient(i_servers, pool_size=i_workers, timeout=i_timeout, retries=i_retries)
+        # closed in the finally below, also when the run fails or is cancelled halfway
+        journal = None
+        pipeline = None
+        results = None
+        writer = None
+        try:
+            if len(i_servers) > 1:
+                feedback.pushInfo('Tree detection servers: {}'.format(', '.join(i_servers)))
+
+            settings = {}
+            if i_patch_size is not None:
+                settings['patch_size'] = i_patch_size
+            if i_patch_overlap is not None:
+                settings['patch_overlap'] = i_patch_overlap
+            if i_thresh is not None:
+                settings['thresh'] = i_thresh
+            if i_iou_thresh is not None:
+                settings['iou_threshold'] = i_iou_thresh
+            detector_settings = dict(settings)
+            if i_raw_floor > 0:
+                # the detector returns everything down to the floor, the threshold is applied here
+                detector_settings['thresh'] = min(i_raw_floor, i_thresh)
+            if bool(detector_settings):
+                if client.post_settings(detector_settings):
+                    feedback.pushInfo('Applied custom settings: {}'.format(detector_settings))
+                else:
+                    feedback.pushInfo('Could not apply settings: {}'.format(detector_settings))
+
+            sl_rect = source_layer.extent()  # use to transform coordinates
+            raster_layer = QgsRasterLayer(source_layer.source())
+            crs = raster_layer.crs().authid()
+
+            feedback.pushInfo('Tree detection window size: {}'.format(i_patch_size))
+
+            feedback.pushInfo('Layer: ' + str(source_layer))
+            feedback.pushInfo('CRS: {}'.format(crs))
+            feedback.pushInfo('Extent: x:{:.2f} y:{:.2f} w:{:.2f} h:{:.2f}'
+                              .format(sl_rect.xMinimum(), sl_rect.yMinimum(), sl_rect.width(), sl_rect.height()))
+            feedback.pushInfo('Image dimensions: {} x {}'.format(source_layer.width(), source_layer.height()))
+
+            source_provider = source_layer.dataProvider()
+            ds_uri = str(source_provider.dataSourceUri())
+            ds = gdal.Open(ds_uri)
+            feedback.pushInfo('RasterCount: {} bands'.format(ds.RasterCount))
+
+            # slices are only handed to other threads when there are several workers
+            reader = TileReader(ds, i_slice_size,
+                                reuse_buffer=(i_workers <= 1 and i_encoders == 0 and i_batch == 1
+                                              and i_transport == 'Threads'),
+                                block_aligned=i_block_align)
+            codec = make_codec(i_codec, quality=i_codec_quality, optimize=i_codec_optimize)
+            if i_block_align:
+                feedback.pushInfo('Block size: {} x {}'.format(*reversed(reader.block_size())))
+            feedback.pushInfo('Destination folder: {}'.format(dest_folder))
+
+            sl_height = reader.height
+            sl_width = reader.width
+            total_parts = reader.total_parts
+            feedback.pushInfo('Slicing into {} parts of {} x {}'.format(total_parts, reader.slice_h, reader.slice_v))
+
+            if i_min_valid > 0 and reader.load_mask():
+                feedback.pushInfo('Skipping slices with less than {:.0%} valid pixels'.format(i_min_valid))
+
+            # classify slices as vegetated or not on an overview, before any upload
+            treeless_parts = set()
+            if i_veg_fraction > 0:
+                reader.load_vegetation(i_veg_index)
+                treeless_parts = {tile.index for tile in reader.tiles()
+                                  if reader.vegetation_fraction(tile, i_veg_thresh) < i_veg_fraction}
+                feedback.pushInfo('Vegetation pre-screen ({} > {}): {} of {} parts look treeless, '
+                                  '~{:.0%} fewer requests'.format(i_veg_index, i_veg_thresh, len(treeless_parts),
+                                                                  total_parts, len(treeless_parts) / total_parts))
+
+            empty_parts = set()
+            if i_min_valid > 0:
+                empty_parts = {tile.index for tile in reader.tiles()
+                               if reader.valid_fraction(tile) < i_min_valid}
+            skipped_count = len(empty_parts)
+            treeless_count = len(treeless_parts - empty_parts)
+            skipped_parts = empty_parts | treeless_parts
+            dispatch_parts = total_parts - len(skipped_parts)
+            if dispatch_parts < total_parts:
+                feedback.pushInfo('Skipping {} empty and {} treeless parts, {} parts left'
+                                  .format(skipped_count, treeless_count, dispatch_parts))
+
+            # everything that changes the boxes of a slice, so a run only resumes from the same job
+            journal = TileJournal(dest_folder, {
+                'raster': ds_uri,
+                'width': reader.width,
+                'height': reader.height,
+                'slice_size': i_slice_size,
+                'block_aligned': i_block_align,
+                'detector': detector_settings,
+                'codec': i_codec,
+                'codec_quality': i_codec_quality,
+                'codec_optimize': i_codec_optimize,
+            })
+            # the journal does not cover the pre-screens, slices they skip now are skipped
+            done_parts = {index: json_boxes for index, json_boxes in (journal.load() if i_resume else {}).items()
+                          if index not in skipped_parts}
+            journal.open(i_resume)
+            dispatch_set = {tile.index for tile in reader.tiles()} - skipped_parts - set(done_parts)
+            dispatch_parts = len(dispatch_set)
+            if done_parts:
+                feedback.pushInfo('Resuming from {}: {} parts already done, {} parts left'
+                                  .format(journal.path, len(done_parts), dispatch_parts))
+
+            cache = None
+            models = client.model_versions() if i_cache_size > 0 else []
+            if '' in models:
+                # without a version, boxes of an older model would come back after the model is updated
+                feedback.pushInfo('Not using the result cache: not every server reports its model version')
+            elif models:
+                cache = TileCache(os.path.join(QgsApplication.qgisSettingsDirPath(), 'deepforest_cache'),
+                                  i_cache_size * 1024 * 1024, {
+                                      'detector': detector_settings,
+                                      'models': models,
+                                      'codec': i_codec,
+                                      'codec_quality': i_codec_quality,
+                                      'codec_optimize': i_codec_optimize,
+                                  })
+            tile_keys = {}
+            cached_count = 0
+            cache_hits = deque()  # found by read_tiles, possibly on the pipeline's reader thread
+
+            def read_tiles():
+                nonlocal cached_count
+                for tile in reader.tiles():
+                    if tile.index in dispatch_set:
+                        part = reader.read(tile)
+                        if cache is not None:
+                            key = cache.key(part)
+                            json_boxes = cache.get(key)
+                            if json_boxes is not None:
+                                cached_count = cached_count + 1
+                                cache_hits.append((tile, json_boxes))
+                                continue
+                            tile_keys[tile.index] = key
+                        yield tile, part
+
+            def remember(tile, json_boxes):
+                journal.record(tile, json_boxes)
+                if cache is not None:
+                    cache.put(tile_keys.pop(tile.index), json_boxes)
+
+            def send(tile, data):
+                return client.tree_rects(codec.file_name(tile), data, codec.mime_type)
+
+            def entry(tile, data):
+                return tile.index, tile.x0, tile.y0, codec.file_name(tile), data, codec.mime_type
+
+            def detect(batch):
+                return client.tree_rects_many([entry(tile, codec.encode(part)) for tile, part in batch], sizer)
+
+            async def detect_async(batch):
+                entries = []
+                for tile, part in batch:
+                    data = await client.loop.run_in_executor(None, codec.encode, part)
+                    entries.append(entry(tile, data))
+                return await client.tree_rects_many_async(entries, sizer)
+
+            def tile_index(item):
+                return item[0].index
+
+            # keep the slices of all batches in flight within BATCH_MEMORY: run_ordered holds up to
+            # two batches per worker, each with its raw slices, until their results are in
+            slice_bytes = (reader.slice_v + reader.overlap_v) * (reader.slice_h + reader.overlap_h) * 3
+            workers = max(1, min(i_workers, self.BATCH_MEMORY // (2 * slice_bytes)))
+            if workers < i_workers and i_encoders == 0:
+                feedback.pushInfo('Sending up to {} requests at a time instead of {}, '
+                                  'to keep slices in memory under {} MB'
+                                  .format(workers, i_workers, self.BATCH_MEMORY // (1024 * 1024)))
+            max_batch = max(1, min(32, self.BATCH_MEMORY // (slice_bytes * workers * 2)))
+            sizer = BatchSizer(fixed=min(i_batch, max_batch) if i_batch > 0 else None, max_size=max_batch)
+            if i_batch != 1:
+                feedback.pushInfo('Slices per request: {}'.format(sizer.fixed or 'auto, at most {}'.format(max_batch)))
+
+            if i_encoders > 0:
+                feedback.pushInfo('Pipeline: reading, {} encoder processes, {} upload threads'
+                                  .format(i_encoders, i_workers))
+                if i_batch != 1:
+                    feedback.pushInfo('The pipeline sends slices one by one, slices per request is ignored')
+                pipeline = TilePipeline(read_tiles(), codec.encode, send, i_encoders, i_workers, feedback.isCanceled)
+                results = pipeline.run()
+            elif i_transport == 'asyncio':
+                feedback.pushInfo('Sending up to {} requests at a time from an asyncio loop'.format(workers))
+                results = ((item[0], future) for item, future in unbatch(
+                    run_ordered(None, batched(read_tiles(), sizer), workers, feedback.isCanceled,
+                                submit=lambda batch: client.submit(detect_async(batch))), tile_index))
+            else:
+                if workers > 1:
+                    feedback.pushInfo('Sending up to {} requests at a time'.format(workers))
+                results = ((item[0], future) for item, future in unbatch(
+                    run_ordered(detect, batched(read_tiles(), sizer), workers, feedback.isCanceled), tile_index))
+
+            count = 0
+            failed_tiles = []
+            # boxes are transformed with the geotransform of the raster, which includes rotation
+            geotransform = ds.GetGeoTransform(can_return_null=True) or extent_geotransform(
+                (sl_rect.xMinimum(), sl_rect.yMinimum(), sl_rect.width(), sl_rect.height()), sl_width, sl_height)
+
+            def merge(columns):
+                if i_merge == 'Centre in box':
+                    keep, removed = overlap_duplicates(*envelope(columns))
+                    return take_rows(columns, keep), removed
+                return merge_overlapping(columns, i_iou_thresh, fuse=i_merge == 'Weighted box fusion')
+
+            current_datetime = datetime.datetime.now()
+            time_str = current_datetime.strftime("%Y-%m-%d_%H%M")
+            output_file_name = 'trees_{ts}.{ext}'.format(ts=time_str, ext=self.FORMAT_EXTENSIONS[i_format])
+            output_file_path = '{df}/{fn}'.format(df=dest_folder, fn=output_file_name)
+            settings_file_path = '{df}/settings_{ts}.json'.format(df=dest_folder, ts=time_str)
+            raw_file_path = '{df}/detections_{ts}.npz'.format(df=dest_folder, ts=time_str)
+
+            # overlapping trees are merged as soon as the slices around them are finished,
+            # and written out straight away
+            merger = SeamMerger(list(reader.tiles()), geotransform, merge)
+            if i_format == 'GeoParquet':
+                srs = ds.GetSpatialRef()
+                writer = GeoParquetWriter(output_file_path, json.loads(srs.ExportToPROJJSON()) if srs else None)
             else:
-                feedback.pushInfo('Could not apply settings: {}'.format(settings))
-
-        sl_rect = source_layer.extent()  # use to transform coordinates
-        raster_layer = QgsRasterLayer(source_layer.source())
-        crs = raster_layer.crs().authid()
-
-        feedback.pushInfo('Tree detection window size: {}'.format(i_patch_size))
-
-        feedback.pushInfo('Layer: ' + str(source_layer))
-        feedback.pushInfo('CRS: {}'.format(crs))
-        feedback.pushInfo('Extent: x:{:.2f} y:{:.2f} w:{:.2f} h:{:.2f}'
-                          .format(sl_rect.xMinimum(), sl_rect.yMinimum(), sl_rect.width(), sl_rect.height()))
-        feedback.pushInfo('Image dimensions: {} x {}'.format(source_layer.width(), source_layer.height()))
-
-        source_provider = source_layer.dataProvider()
-        ds_uri = str(source_provider.dataSourceUri())
-        ds = gdal.Open(ds_uri)
-        feedback.pushInfo('RasterCount: {} bands'.format(ds.RasterCount))
-
-        arr_1 = ds.GetRasterBand(1).ReadAsArray()
-        arr_2 = ds.GetRasterBand(2).ReadAsArray()
-        arr_3 = ds.GetRasterBand(3).ReadAsArray()
-        three_band = np.array([arr_1, arr_2, arr_3])
-        three_band = np.transpose(three_band, (1, 2, 0))
-        feedback.pushInfo('Destination folder: {}'.format(dest_folder))
-
-        slicing = i_slice_size
-        slice_overlap = 1.1  # percentage overlap
-
-        sl_height = three_band.shape[0]
-        sl_width = three_band.shape[1]
-        part_count_v = math.ceil(sl_height / slicing)
-        part_count_h = math.ceil(sl_width / slicing)
-        slice_v = math.ceil(sl_height / part_count_v)
-        slice_h = math.ceil(sl_width / part_count_h)
-
-        total_parts = part_count_v * part_count_h
-        feedback.pushInfo('Slicing into {} parts of {} x {}'.format(total_parts, slice_h, slice_v))
-
-        count = 0
-        feature_list = []
-
-        for y0 in range(0, sl_height, slice_v):
-            if feedback.isCanceled():
-                break
-            for x0 in range(0, sl_width, slice_h):
+                writer = GeoJsonWriter(output_file_path, crs, seq=i_format == 'GeoJSONSeq')
+            (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_TREES, context, FeatureSinkWriter.fields(),
+                                                   QgsWkbTypes.Polygon, raster_layer.crs())
+            sink_writer = FeatureSinkWriter(sink) if sink is not None else None
+            raw_boxes = []
+
+            def finish(tile, json_boxes):
+                columns = boxes_to_columns(json_boxes, tile, geotransform)
+                if i_raw_floor > 0:
+                    raw_boxes.append(columns)
+                    columns = take_rows(columns, columns['score'] >= i_thresh)
+                columns = merger.finish(tile.index, columns)
+                writer.write(columns)
+                if sink_writer is not None:
+                    sink_writer.write(columns)
+
+            for index in skipped_parts:
+                merger.finish(index)
+            for tile in reader.tiles():
+                if tile.index in done_parts:
+                    finish(tile, done_parts[tile.index])
+
+            def finish_cached():
+                while cache_hits:
+                    tile, json_boxes = cache_hits.popleft()
+                    journal.record(tile, json_boxes)
+                    finish(tile, json_boxes)
+
+            for tile, result in results:
+                for event in client.endpoints.drain_events():
+                    feedback.pushInfo(event)
+                finish_cached()
+                try:
+                    json_boxes = result.result()
+                    remember(tile, json_boxes)
+                    finish(tile, json_boxes)
+                except (DetectorError, OSError, ValueError) as ex:
+                    # requests and connection errors are all OSErrors, bad JSON is a ValueError
+                    feedback.pushInfo('Part {} failed, will retry at the end: {}'.format(tile.index, ex))
+                    failed_tiles.append(tile)
+
+                count = count + 1
+                feedback.pushInfo('Processed part: {}/{}'.format(count + cached_count, dispatch_parts))
+
+                feedback.setProgress(int((count + cached_count) / dispatch_parts * 100))
+
+            finish_cached()
+
+            # give the slices that failed one more go, one at a time, now the servers are not busy
+            missing_parts = []
+            for tile in failed_tiles:
                 if feedback.isCanceled():
                     break
-                y_max = y0 + math.ceil(slice_v * slice_overlap)
-                x_max = x0 + math.ceil(slice_h * slice_overlap)
-                part = three_band[y0:y_max, x0:x_max, 0:3]
-                img = Image.fromarray(part, 'RGB')
-                img_file_name = dest_folder + '/part_' + str(x0) + '_' + str(y0) + '.jpg'
-                img.save(img_file_name, quality=90, optimize=True, subsampling=0)
-
-                with open(img_file_name, 'rb') as img_file:
-                    files = {'file': img_file}
-                    resp = session.post(self.BASE_URL + 'tree_rects',
-                                        files=files,
-                                        cookies={'session': 'deepforest_plugin'})
-
-                    if resp.status_code == 200:
-                        str_content = resp.content.decode('utf-8')
-                        json_boxes = json.loads(str_content)
-
-                        for b in range(0, len(json_boxes)):
-                            # transform these coordinates using extent
-                            xmin = (x0 + json_boxes[b]['xmin']) / sl_width
-                            xmin = sl_rect.xMinimum() + (xmin * sl_rect.width())
-                            xmax = (x0 + json_boxes[b]['xmax']) / sl_width
-                            xmax = sl_rect.xMinimum() + (xmax * sl_rect.width())
-
-                            # QGIS uses 0.0 at BOTTOM left corner instead of top!
-                            ymin = 1 - (y0 + json_boxes[b]['ymin']) / sl_height
-                            ymin = sl_rect.yMinimum() + (ymin * sl_rect.height())
-                            ymax = 1 - (y0 + json_boxes[b]['ymax']) / sl_height
-                            ymax = sl_rect.yMinimum() + (ymax * sl_rect.height())
-
-                            properties = {
-                                'slice': count,
-                                'tree': b,
-                                'xg_0': xmin,
-                                'xg_1': xmax,
-                                'yg_0': ymin,
-                                'yg_1': ymax
-                            }
-
-                            properties.update(json_boxes[b])
-
-                            feature = {
-                                "type": "Feature",
-                                "geometry": {
-                                    "type": "Polygon",
-                                    "coordinates": [[
-                                        [xmin, ymin],
-                                        [xmin, ymax],
-                                        [xmax, ymax],
-                                        [xmax, ymin],
-                                        [xmin, ymin]
-                                    ]]
-                                },
-                                "properties": properties
-                            }
-                            feature_list.append(feature)
-                    else:
-                        feedback.pushInfo('Error: {}'.format(resp.status_code))
-
-                os.remove(img_file_name)
-                count = count + 1
-                feedback.pushInfo('Processed part: {}/{}'.format(count, total_parts))
-
-                feedback.setProgress(int(count / total_parts * 100))
-
-        # remove overlapping rectangles from list
-        dupe_count = 0
-        idx_1 = 0
-        while idx_1 < len(feature_list):
-            idx_2 = idx_1 + 1  # starting index
-            while idx_2 < len(feature_list):
-                if overlap(feature_list[idx_1]['properties'],
-                           feature_list[idx_2]['properties']):
-                    dupe_count = dupe_count + 1
-                    # print("{} {} and {} {}".format(
-                    #     feature_list[idx_1]['properties']['slice'],
-                    #     feature_list[idx_1]['properties']['tree'],
-                    #     feature_list[idx_2]['properties']['slice'],
-                    #     feature_list[idx_2]['properties']['tree']))
-                    # delete smallest of the two rectangles
-                    area_r1 = get_area(feature_list[idx_1]['properties'])
-                    area_r2 = get_area(feature_list[idx_2]['properties'])
-                    if area_r1 > area_r2:
-                        feature_list.pop(idx_2)
-                        idx_2 = idx_2 - 1  # this index now points to another item -> check again
-                        if idx_2 < 0 or idx_2 >= len(feature_list):
-                            break
-                    else:
-                        feature_list.pop(idx_1)
-                        idx_1 = idx_1 - 1  # this index now points to another item -> check again
-                        if idx_1 < 0 or idx_1 >= len(feature_list):
-                            break
-                idx_2 = idx_2 + 1
-            idx_1 = idx_1 + 1
-
-        # write to file
-        current_datetime = datetime.datetime.now()
-        time_str = current_datetime.strftime("%Y-%m-%d_%H%M")
-        output_file_name = 'trees_{ts}.geojson'.format(ts=time_str)
-        output_file_path = '{df}/{fn}'.format(df=dest_folder, fn=output_file_name)
-        settings_file_path = '{df}/settings_{ts}.json'.format(df=dest_folder, ts=time_str)
-
-        with open(output_file_path, 'wt') as out_file:
-            geo_json = {
-                'type': 'FeatureCollection',
-                'features': feature_list,
-                'crs': {
-                    'type': 'name',
-                    'properties': {
-                        'name': crs
+                try:
+                    json_boxes = send(tile, codec.encode(reader.read(tile)))
+                except (DetectorError, OSError, ValueError) as ex:
+                    feedback.pushInfo('Part {} is missing: {}'.format(tile.index, ex))
+                    missing_parts.append({'slice': tile.index, 'x0': tile.x0, 'y0': tile.y0,
+                                          'width': tile.width, 'height': tile.height, 'error': str(ex)})
+                    continue
+                feedback.pushInfo('Part {} recovered'.format(tile.index))
+                remember(tile, json_boxes)
+                finish(tile, json_boxes)
+            columns = merger.close()
+            writer.write(columns)
+            writer.close()
+            if sink_writer is not None:
+                sink_writer.write(columns)
+            dupe_count = merger.removed
+            if cache is not None:
+                feedback.pushInfo('Result cache: {} parts found, {} parts detected'.format(cache.hits, cache.misses))
+            if failed_tiles:
+                feedback.pushInfo('Recovered {} of {} failed parts'
+                                  .format(len(failed_tiles) - len(missing_parts), len(failed_tiles)))
+            if missing_parts:
+                feedback.reportError('{} parts could not be processed, their trees are missing'
+                                     .format(len(missing_parts)))
+
+            if pipeline is not None:
+                feedback.pushInfo('Pipeline bottleneck: {}'.format(pipeline.summary()['bottleneck']))
+            if i_batch != 1 and not sizer.supported:
+                feedback.pushInfo('The server has no tree_rects_batch endpoint, slices were sent one by one')
+
+            raw_columns = None
+            if i_raw_floor > 0:
+                raw_columns = concat_columns(raw_boxes)
+                raw_columns = take_rows(raw_columns, np.lexsort((raw_columns['tree'], raw_columns['slice'])))
+
+            # write to file
+            if raw_columns is not None:
+                save_raw_detections(raw_file_path, raw_columns, {
+                    'crs': crs,
+                    'raster': ds_uri,
+                    'detector': detector_settings,
+                    'floor': detector_settings['thresh'],
+                    'thresh': i_thresh,
+                })
+                feedback.pushInfo('Written {} raw detections to {}'.format(len(raw_columns['slice']), raw_file_path))
+
+            with open(settings_file_path, 'wt') as out_file:
+                settings['filename'] = output_file_name
+                settings['format'] = i_format
+                settings['crs'] = crs
+                settings['slice_size'] = i_slice_size
+                settings['block_aligned'] = i_block_align
+                settings['codec'] = i_codec
+                settings['workers'] = i_workers
+                settings['transport'] = i_transport
+                settings['servers'] = client.endpoints.summary()
+                if pipeline is None:
+                    settings['batching'] = sizer.summary()
+                if pipeline is not None:
+                    settings['pipeline'] = pipeline.summary()
+                settings['parts'] = total_parts
+                settings['skipped_empty_parts'] = skipped_count
+                settings['timeout'] = i_timeout
+                settings['retries'] = i_retries
+                settings['failed_parts'] = len(failed_tiles)
+                settings['missing_parts'] = missing_parts
+                settings['journal'] = journal.path
+                settings['resumed_parts'] = len(done_parts)
+                if cache is not None:
+                    settings['cache'] = cache.summary()
+                if i_veg_fraction > 0:
+                    settings['vegetation_screen'] = {
+                        'index': i_veg_index,
+                        'threshold': i_veg_thresh,
+                        'min_fraction': i_veg_fraction,
+                        'skipped_treeless_parts': treeless_count,
+                        'estimated_savings': treeless_count / total_parts,
+                    }
+                if raw_columns is not None:
+                    settings['raw_detections'] = {
+                        'filename': 'detections_{ts}.npz'.format(ts=time_str),
+                        'floor': detector_settings['thresh'],
+                        'boxes': len(raw_columns['slice']),
                     }
-                }
-            }
-            out_file.write(json.dumps(geo_json, indent=1))
-
-        with open(settings_file_path, 'wt') as out_file:
-            settings['filename'] = output_file_name
-            settings['slice_size'] = i_slice_size
-            settings['parts'] = total_parts
-            settings['overlapping_trees_removed'] = dupe_count
-            settings['total_trees'] = len(feature_list)
-            out_file.write(json.dumps(settings, indent=1))
-
-        feedback.pushInfo('Written {}'.format(output_file_path))
-        feedback.setProgress(1)
-
-        # TODO: return as output
-        # (sink, dest_id) = self.parameterAsRasterLayer(parameters, self.OUTPUT, context, None, None, None)
-        #     # Add a feature in the sink
-        #     sink.addFeature(feature, QgsFeatureSink.FastInsert)
-
-        return {self.OUTPUT: None}
+                settings['merge'] = i_merge
+                settings['overlapping_trees_removed'] = dupe_count
+                settings['total_trees'] = writer.count
+                out_file.write(json.dumps(settings, indent=1))
+
+            feedback.pushInfo('Written {}'.format(output_file_path))
+            feedback.setProgress(1)
+
+            return {self.OUTPUT: dest_folder, self.OUTPUT_TREES: dest_id}
+        finally:
+            if results is not None:
+                results.close()  # stops the pipeline or the worker pool
+            if writer is not None:
+                writer.close()
+            if journal is not None:
+                journal.close()
+            client.close()
 
     def icon(self):
         return QIcon(':/plugins/deepforestplugin/icon.png')
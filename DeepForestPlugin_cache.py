@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class TileCache(object):
+    """
+    An on-disk cache of the boxes found in a slice, keyed by a hash of its
+    pixels and of everything else that changes the result: the detector
+    settings, the model version and the encoding. Every entry is a small
+    JSON file; the least recently used ones are removed when the cache
+    grows over max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes, settings):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.salt = json.dumps(settings, sort_keys=True).encode('utf-8')
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (last used, size)
+        self._bytes = 0
+        os.makedirs(folder, exist_ok=True)
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                self._entries[entry.name[:-5]] = (stat.st_mtime, stat.st_size)
+                self._bytes = self._bytes + stat.st_size
+
+    def key(self, rgb):
+        digest = hashlib.sha1(self.salt)
+        digest.update(str(rgb.shape).encode('ascii'))
+        digest.update(memoryview(np.ascontiguousarray(rgb)).cast('B'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        The cached boxes, or None.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses = self.misses + 1
+                return None
+        try:
+            with open(self._path(key), 'rt') as cache_file:
+                boxes = json.load(cache_file)
+            # put() can evict the entry from another thread while the file is read
+            with self._lock:
+                if key in self._entries:
+                    os.utime(self._path(key))
+                    self._entries[key] = (os.path.getmtime(self._path(key)), self._entries[key][1])
+                    self.hits = self.hits + 1
+                    return boxes
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            self.misses = self.misses + 1
+            self._forget(key)
+        return None
+
+    def put(self, key, boxes):
+        data = json.dumps(boxes)
+        temp_path = '{}.{}.tmp'.format(self._path(key), threading.get_ident())
+        try:
+            with open(temp_path, 'wt') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, self._path(key))
+            used = os.path.getmtime(self._path(key))
+        except OSError:
+            return  # a full or read-only disk only costs cache hits
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (used, len(data))
+            self._bytes = self._bytes + len(data)
+            self._evict()
+
+    def summary(self):
+        return {
+            'folder': self.folder,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+        }
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def _forget(self, key):
+        if key in self._entries:
+            self._bytes = self._bytes - self._entries.pop(key)[1]
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][0]):
+            if self._bytes <= self.max_bytes:
+                break
+            self._forget(key)
+            self.evictions = self.evictions + 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import asyncio
+import json
+import random
+import re
+import ssl
+import statistics
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import requests
+
+
+class DetectorError(Exception):
+    """
+    Raised when the tree detection server does not answer a request; the
+    HTTP status is kept when there was one.
+    """
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def batch_manifest(entries):
+    """
+    The JSON part of a tree_rects_batch request. Every slice is uploaded
+    as its own file part named file_<id>, the manifest tells the server
+    where the slices sit in the raster:
+
+        [{"id": 3, "x0": 7000, "y0": 0, "file": "file_3"}, ...]
+
+    and the server answers with the boxes of every slice by id:
+
+        {"3": [{"xmin": ..., "ymin": ..., ...}, ...], ...}
+    """
+    return json.dumps([{'id': tile_id, 'x0': x0, 'y0': y0, 'file': 'file_{}'.format(tile_id)}
+                       for tile_id, x0, y0, _, _, _ in entries])
+
+
+def batch_boxes(content, entries):
+    """
+    Parses a tree_rects_batch answer into a dict of box lists by slice id.
+    """
+    boxes = json.loads(content.decode('utf-8'))
+    missing = [tile_id for tile_id, _, _, _, _, _ in entries if str(tile_id) not in boxes]
+    if missing:
+        raise DetectorError('Error: no boxes for slices {}'.format(missing))
+    return {tile_id: boxes[str(tile_id)] for tile_id, _, _, _, _, _ in entries}
+
+
+def retry_delay(retry, backoff, cap=60.0):
+    """
+    Seconds to wait before the given retry (1, 2, ...): exponential
+    backoff with some jitter, so clients do not all come back at once.
+    """
+    return min(cap, backoff * 2 ** (retry - 1)) * random.uniform(0.5, 1.5)
+
+
+def gave_up(error, retries):
+    """
+    The DetectorError that is raised when a request failed on every try.
+    """
+    if retries == 0:
+        return error if isinstance(error, DetectorError) else DetectorError('Error: {}'.format(error))
+    return DetectorError('{} (gave up after {} retries)'.format(error, retries), getattr(error, 'status', None))
+
+
+def split_urls(text):
+    """
+    Splits a comma or whitespace separated list of server urls, making
+    sure every url ends with a slash.
+    """
+    return [url if url.endswith('/') else url + '/' for url in re.split(r'[\s,;]+', text) if url]
+
+
+class Endpoint(object):
+    """
+    One inference server and what is known about its health.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None  # smoothed seconds per request
+        self.down_until = 0.0
+        self.removals = 0
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'requests': self.requests,
+            'failures': self.failures,
+            'removals': self.removals,
+            'latency_seconds': None if self.latency is None else round(self.latency, 3),
+            'healthy': self.down_until <= time.monotonic(),
+        }
+
+
+class EndpointPool(object):
+    """
+    Spreads requests over several inference servers, sending each one to
+    the server with the fewest requests outstanding. A server is taken
+    out of rotation after max_failures failures in a row, or when it is
+    slow_factor times slower than the median of the others, and gets
+    another chance after a cooldown that doubles every time it is removed.
+    Safe to use from several threads.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+    MIN_REQUESTS_FOR_SLOW = 5
+
+    def __init__(self, urls, max_failures=3, cooldown=30.0, slow_factor=4.0):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.slow_factor = slow_factor
+        self.events = []
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        """
+        Picks the server for the next request, or None when every server
+        has been excluded. When all servers are down, the one that comes
+        back first is used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.down_until <= now]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: (e.outstanding, e.latency or 0.0))
+            else:
+                endpoint = min(candidates, key=lambda e: e.down_until)
+            endpoint.outstanding = endpoint.outstanding + 1
+            return endpoint
+
+    def release(self, endpoint, elapsed, ok):
+        """
+        Records the outcome of a request sent to endpoint; ok is None for a
+        request that was abandoned before it had one, e.g. cancelled.
+        """
+        with self._lock:
+            endpoint.outstanding = endpoint.outstanding - 1
+            if ok is None:
+                return
+            endpoint.requests = endpoint.requests + 1
+            if not ok:
+                endpoint.failures = endpoint.failures + 1
+                endpoint.consecutive_failures = endpoint.consecutive_failures + 1
+                if endpoint.consecutive_failures >= self.max_failures and endpoint.down_until <= time.monotonic():
+                    self._remove(endpoint, '{} failures in a row'.format(endpoint.consecutive_failures))
+                return
+
+            endpoint.consecutive_failures = 0
+            if endpoint.removals > 0 and endpoint.down_until and endpoint.down_until <= time.monotonic():
+                # back after a cooldown: forget how slow it used to be
+                endpoint.down_until = 0.0
+                endpoint.latency = elapsed
+                self.events.append('Server {} is back'.format(endpoint.url))
+            elif endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency = endpoint.latency + self.LATENCY_SMOOTHING * (elapsed - endpoint.latency)
+            self._check_slow(endpoint)
+
+    def _check_slow(self, endpoint):
+        now = time.monotonic()
+        if endpoint.down_until > now:
+            return  # a request that was sent before the server was removed
+        others = [e.latency for e in self.endpoints
+                  if e is not endpoint and e.latency is not None and e.down_until <= now]
+        if not others or endpoint.requests < self.MIN_REQUESTS_FOR_SLOW:
+            return
+        median = statistics.median(others)
+        if endpoint.latency > self.slow_factor * median:
+            self._remove(endpoint, '{:.1f}s per request, others take {:.1f}s'.format(endpoint.latency, median))
+
+    def _remove(self, endpoint, reason):
+        endpoint.removals = endpoint.removals + 1
+        cooldown = self.cooldown * 2 ** min(endpoint.removals - 1, 5)
+        endpoint.down_until = time.monotonic() + cooldown
+        # one more failure after the cooldown takes it out again
+        endpoint.consecutive_failures = self.max_failures - 1
+        self.events.append('Server {} removed for {:.0f}s: {}'.format(endpoint.url, cooldown, reason))
+
+    def drain_events(self):
+        """
+        Returns and forgets the messages about servers that were removed
+        or came back.
+        """
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def summary(self):
+        with self._lock:
+            return [endpoint.as_dict() for endpoint in self.endpoints]
+
+
+class TreeDetectorClient(object):
+    """
+    Talks to the DeepForest web service. A single requests session is
+    shared by all calls, so connections are kept alive and pooled, and it
+    can be used from several threads at once. Requests are spread over
+    the servers of the endpoint pool; a slice whose server fails is sent
+    to the next one. When every server failed, the whole round is
+    retried up to retries times, with exponential backoff in between.
+    """
+
+    COOKIES = {'session': 'deepforest_plugin'}
+    CONNECT_TIMEOUT = 10.0
+
+    def __init__(self, base_urls, pool_size=10, timeout=None, retries=0, backoff=1.0):
+        self.endpoints = EndpointPool([base_urls] if isinstance(base_urls, str) else base_urls)
+        self.timeout = None if timeout is None else (self.CONNECT_TIMEOUT, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints.endpoints),
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post_settings(self, settings):
+        """
+        Applies detection settings on every server, returns True when all
+        of them accepted them.
+        """
+        headers = {'Content-Type': 'application/json'}
+        ok = True
+        for endpoint in self.endpoints.endpoints:
+            try:
+                resp = self.session.post(endpoint.url + 'settings',
+                                         headers=headers,
+                                         data=json.dumps(settings),
+                                         cookies=self.COOKIES,
+                                         timeout=self.timeout)
+                ok = ok and resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+        return ok
+
+    def model_versions(self):
+        """
+        The model versions the servers report on their version endpoint, an
+        empty string for a server that does not have one.
+        """
+        versions = set()
+        for endpoint in self.endpoints.endpoints:
+            try:
+                resp = self.session.get(endpoint.url + 'version', cookies=self.COOKIES, timeout=self.timeout)
+                versions.add(resp.text.strip() if resp.status_code == 200 else '')
+            except requests.RequestException:
+                versions.add('')
+        return sorted(versions)
+
+    def tree_rects(self, file_name, data, mime_type):
+        """
+        Uploads one encoded slice and returns the list of detected boxes,
+        in pixel coordinates of the slice.
+        """
+        content = self._post('tree_rects', [('file', (file_name, data, mime_type))])
+        return json.loads(content.decode('utf-8'))
+
+    def tree_rects_batch(self, entries):
+        """
+        Uploads several encoded slices in one request, see batch_manifest().
+        Entries are (tile_id, x0, y0, file_name, data, mime_type) tuples;
+        returns a dict of box lists by tile id.
+        """
+        files = [('tiles', (None, batch_manifest(entries), 'application/json'))]
+        files += [('file_{}'.format(tile_id), (file_name, data, mime_type))
+                  for tile_id, _, _, file_name, data, mime_type in entries]
+        return batch_boxes(self._post('tree_rects_batch', files), entries)
+
+    def tree_rects_many(self, entries, sizer=None):
+        """
+        Boxes for several encoded slices, by tile id: in one batch request
+        when there is more than one slice and the server supports it, with
+        a request per slice otherwise. Request times are recorded in the
+        sizer, which is told when the server has no batch endpoint.
+        """
+        start = time.monotonic()
+        if len(entries) > 1 and (sizer is None or sizer.supported):
+            try:
+                boxes = self.tree_rects_batch(entries)
+                if sizer is not None:
+                    sizer.record(len(entries), time.monotonic() - start)
+                return boxes
+            except DetectorError as ex:
+                if ex.status != 404 or sizer is None:
+                    raise
+                sizer.supported = False
+        boxes = {}
+        for tile_id, _, _, file_name, data, mime_type in entries:
+            start = time.monotonic()
+            boxes[tile_id] = self.tree_rects(file_name, data, mime_type)
+            if sizer is not None:
+                sizer.record(1, time.monotonic() - start)
+        return boxes
+
+    def _post(self, path, files):
+        tried = []
+        error = None
+        retries = 0
+        while True:
+            endpoint = self.endpoints.acquire(exclude=tried)
+            if endpoint is None:
+                # every server failed: wait, then give them all another go
+                if retries >= self.retries:
+                    raise gave_up(error, retries)
+                retries = retries + 1
+                time.sleep(retry_delay(retries, self.backoff))
+                tried = []
+                continue
+            tried.append(endpoint)
+            start = time.monotonic()
+            try:
+                resp = self.session.post(endpoint.url + path,
+                                         files=files,
+                                         cookies=self.COOKIES,
+                                         timeout=self.timeout)
+                status = resp.status_code
+            except requests.RequestException as ex:
+                status, error = None, ex
+            self.endpoints.release(endpoint, time.monotonic() - start, status is not None and status < 500)
+            if status == 200:
+                return resp.content
+            if status is not None:
+                error = DetectorError('Error: {} from {}'.format(status, endpoint.url), status)
+                if status < 500:
+                    raise error
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncTreeDetectorClient(object):
+    """
+    Talks to the DeepForest web service from an asyncio event loop that
+    runs on its own thread, so thousands of slices can be in flight
+    without a thread per request. Uses plain HTTP/1.1 over asyncio
+    streams with a pool of keep-alive connections per server; at most
+    max_in_flight requests are sent at the same time. Requests are spread
+    over the servers of the endpoint pool, and retried, like
+    TreeDetectorClient does.
+
+    The *_async methods are coroutines for the loop, submit() schedules
+    one from any other thread and returns a concurrent Future.
+    """
+
+    COOKIE = 'session=deepforest_plugin'
+
+    def __init__(self, base_urls, max_in_flight=32, timeout=None, retries=0, backoff=1.0):
+        self.endpoints = EndpointPool([base_urls] if isinstance(base_urls, str) else base_urls)
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._targets = {}
+        self._idle = {}
+        for endpoint in self.endpoints.endpoints:
+            url = urlsplit(endpoint.url)
+            self._targets[endpoint.url] = (url.hostname,
+                                           '[{}]'.format(url.hostname) if ':' in url.hostname else url.hostname,
+                                           url.port or (443 if url.scheme == 'https' else 80),
+                                           url.path if url.path.endswith('/') else url.path + '/',
+                                           ssl.create_default_context() if url.scheme == 'https' else None)
+            self._idle[endpoint.url] = []
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self._semaphore = self.submit(self._make_semaphore()).result()
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.max_in_flight)
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def post_settings(self, settings):
+        """
+        Applies detection settings on every server, returns True when all
+        of them accepted them.
+        """
+        return self.submit(self.post_settings_async(settings)).result()
+
+    def model_versions(self):
+        """
+        The model versions the servers report, like
+        TreeDetectorClient.model_versions().
+        """
+        return self.submit(self.model_versions_async()).result()
+
+    def tree_rects(self, file_name, data, mime_type):
+        """
+        Uploads one encoded slice and returns the list of detected boxes,
+        in pixel coordinates of the slice.
+        """
+        return self.submit(self.tree_rects_async(file_name, data, mime_type)).result()
+
+    def tree_rects_batch(self, entries):
+        """
+        Uploads several encoded slices in one request, like
+        TreeDetectorClient.tree_rects_batch().
+        """
+        return self.submit(self.tree_rects_batch_async(entries)).result()
+
+    def tree_rects_many(self, entries, sizer=None):
+        """
+        Boxes for several encoded slices, like
+        TreeDetectorClient.tree_rects_many().
+        """
+        return self.submit(self.tree_rects_many_async(entries, sizer)).result()
+
+    async def post_settings_async(self, settings):
+        body = json.dumps(settings).encode('utf-8')
+        ok = True
+        for endpoint in self.endpoints.endpoints:
+            try:
+                status, _ = await asyncio.wait_for(self._post(endpoint.url, 'settings', body, 'application/json'),
+                                                   self.timeout)
+                ok = ok and status == 200
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                ok = False
+        return ok
+
+    async def model_versions_async(self):
+        versions = set()
+        for endpoint in self.endpoints.endpoints:
+            try:
+                status, content = await asyncio.wait_for(self._post(endpoint.url, 'version', b'', 'text/plain',
+                                                                    method='GET'), self.timeout)
+                versions.add(content.decode('utf-8').strip() if status == 200 else '')
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                versions.add('')
+        return sorted(versions)
+
+    async def tree_rects_async(self, file_name, data, mime_type):
+        content = await self._post_any('tree_rects', [('file', file_name, data, mime_type)])
+        return json.loads(content.decode('utf-8'))
+
+    async def tree_rects_batch_async(self, entries):
+        parts = [('tiles', None, batch_manifest(entries).encode('utf-8'), 'application/json')]
+        parts += [('file_{}'.format(tile_id), file_name, data, mime_type)
+                  for tile_id, _, _, file_name, data, mime_type in entries]
+        return batch_boxes(await self._post_any('tree_rects_batch', parts), entries)
+
+    async def tree_rects_many_async(self, entries, sizer=None):
+        """
+        Boxes for several encoded slices, like
+        TreeDetectorClient.tree_rects_many().
+        """
+        start = time.monotonic()
+        if len(entries) > 1 and (sizer is None or sizer.supported):
+            try:
+                boxes = await self.tree_rects_batch_async(entries)
+                if sizer is not None:
+                    sizer.record(len(entries), time.monotonic() - start)
+                return boxes
+            except DetectorError as ex:
+                if ex.status != 404 or sizer is None:
+                    raise
+                sizer.supported = False
+        boxes = {}
+        for tile_id, _, _, file_name, data, mime_type in entries:
+            start = time.monotonic()
+            boxes[tile_id] = await self.tree_rects_async(file_name, data, mime_type)
+            if sizer is not None:
+                sizer.record(1, time.monotonic() - start)
+        return boxes
+
+    async def _post_any(self, endpoint_path, parts):
+        """
+        Posts a multipart form of (name, file_name, data, mime_type) parts
+        to one of the servers, moving on to the next server on failure.
+        """
+        boundary = uuid.uuid4().hex
+        chunks = []
+        for name, file_name, data, mime_type in parts:
+            disposition = 'form-data; name="{}"'.format(name)
+            if file_name is not None:
+                disposition = disposition + '; filename="{}"'.format(file_name)
+            chunks += ['--{}\r\n'.format(boundary).encode('ascii'),
+                       'Content-Disposition: {}\r\n'.format(disposition).encode('utf-8'),
+                       'Content-Type: {}\r\n\r\n'.format(mime_type).encode('ascii'),
+                       data,
+                       b'\r\n']
+        chunks.append('--{}--\r\n'.format(boundary).encode('ascii'))
+        body = b''.join(chunks)
+        content_type = 'multipart/form-data; boundary=' + boundary
+
+        tried = []
+        error = None
+        retries = 0
+        async with self._semaphore:
+            while True:
+                endpoint = self.endpoints.acquire(exclude=tried)
+                if endpoint is None:
+                    # every server failed: wait, then give them all another go
+                    if retries >= self.retries:
+                        raise gave_up(error, retries)
+                    retries = retries + 1
+                    await asyncio.sleep(retry_delay(retries, self.backoff))
+                    tried = []
+                    continue
+                tried.append(endpoint)
+                start = time.monotonic()
+                status, ok = None, None
+                try:
+                    status, content = await asyncio.wait_for(
+                        self._post(endpoint.url, endpoint_path, body, content_type), self.timeout)
+                    ok = status < 500
+                except asyncio.TimeoutError:
+                    ok, error = False, DetectorError('Error: timeout from {}'.format(endpoint.url))
+                except (OSError, asyncio.IncompleteReadError) as ex:
+                    ok, error = False, ex
+                except ValueError as ex:
+                    # a malformed status line or header
+                    ok, error = False, DetectorError('Error: bad response from {}: {}'.format(endpoint.url, ex))
+                finally:
+                    self.endpoints.release(endpoint, time.monotonic() - start, ok)
+                if status == 200:
+                    return content
+                if status is not None:
+                    error = DetectorError('Error: {} from {}'.format(status, endpoint.url), status)
+                    if status < 500:
+                        raise error
+
+    async def _post(self, base_url, endpoint, body, content_type, method='POST'):
+        host, host_header, port, path, ssl_context = self._targets[base_url]
+        idle = self._idle[base_url]
+        head = ('{method} {path}{endpoint} HTTP/1.1\r\n'
+                'Host: {host}:{port}\r\n'
+                'Accept: application/json\r\n'
+                'Cookie: {cookie}\r\n'
+                'Content-Type: {content_type}\r\n'
+                'Content-Length: {length}\r\n'
+                'Connection: keep-alive\r\n\r\n').format(method=method, path=path, endpoint=endpoint,
+                                                           host=host_header, port=port, cookie=self.COOKIE,
+                                                           content_type=content_type, length=len(body))
+        while True:
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await asyncio.open_connection(host, port, ssl=ssl_context)
+            try:
+                writer.write(head.encode('latin-1'))
+                writer.write(body)
+                await writer.drain()
+                status, headers, content = await self._read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # the server closed an idle keep-alive connection, retry on a new one
+                raise
+            except BaseException:
+                # timed out or cancelled halfway a response, the connection is of no use anymore
+                writer.close()
+                raise
+            if headers.get('connection', '').lower() == 'close' or reader.at_eof():
+                writer.close()
+            else:
+                idle.append((reader, writer))
+            return status, content
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+            headers['connection'] = 'close'
+
+        if 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b''.join(chunks)
+        else:
+            content = await reader.read()
+            headers['connection'] = 'close'
+        return int(status), headers, content
+
+    def close(self):
+        async def close_idle():
+            for idle in self._idle.values():
+                for _, writer in idle:
+                    writer.close()
+                del idle[:]
+        self.submit(close_idle()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import io
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+from PIL import Image
+
+
+class TileCodec(ABC):
+    """
+    Encodes an (h, w, 3) uint8 slice into the bytes that are uploaded to
+    the tree detector. The file extension and mime type tell the server
+    how to decode it.
+    """
+
+    name = ''
+    extension = ''
+    mime_type = 'application/octet-stream'
+    lossless = True
+
+    def __init__(self, quality=90, optimize=False):
+        self.quality = quality
+        self.optimize = optimize
+
+    @abstractmethod
+    def encode(self, rgb):
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        pass
+
+    def file_name(self, tile):
+        return 'part_{}_{}.{}'.format(tile.x0, tile.y0, self.extension)
+
+
+class PillowCodec(TileCodec):
+    """
+    Any image format Pillow can write, e.g. JPEG, PNG or WebP.
+    """
+
+    pil_format = ''
+
+    def save_options(self):
+        return {}
+
+    def encode(self, rgb):
+        img_buffer = io.BytesIO()
+        Image.fromarray(rgb, 'RGB').save(img_buffer, format=self.pil_format, **self.save_options())
+        return img_buffer.getvalue()
+
+    def decode(self, data):
+        return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+
+class JpegCodec(PillowCodec):
+    name = 'JPEG'
+    extension = 'jpg'
+    mime_type = 'image/jpeg'
+    pil_format = 'JPEG'
+    lossless = False
+
+    def save_options(self):
+        return {'quality': self.quality, 'optimize': self.optimize, 'subsampling': 0}
+
+    def encode(self, rgb):
+        try:
+            return PillowCodec.encode(self, rgb)
+        except OSError:
+            if not self.optimize:
+                raise
+            # optimizing in memory needs the whole image in one Pillow buffer of
+            # about a byte per pixel, which very noisy slices do not fit in
+            return JpegCodec(self.quality, optimize=False).encode(rgb)
+
+
+class PngCodec(PillowCodec):
+    name = 'PNG'
+    extension = 'png'
+    mime_type = 'image/png'
+    pil_format = 'PNG'
+
+    def save_options(self):
+        # low compression levels are much faster and barely bigger
+        return {'compress_level': 9 if self.optimize else 1}
+
+
+class WebpCodec(PillowCodec):
+    name = 'WebP'
+    extension = 'webp'
+    mime_type = 'image/webp'
+    pil_format = 'WEBP'
+    lossless = False
+
+    def save_options(self):
+        return {'quality': self.quality, 'method': 6 if self.optimize else 0}
+
+
+class RawCodec(TileCodec):
+    """
+    Uncompressed pixels behind a small header: magic, height, width and
+    number of bands as little-endian unsigned ints.
+    """
+
+    name = 'Raw uint8'
+    extension = 'raw'
+    HEADER = struct.Struct('<4sIII')
+    MAGIC = b'RGB8'
+
+    def encode(self, rgb):
+        height, width, bands = rgb.shape
+        return self.HEADER.pack(self.MAGIC, height, width, bands) + np.ascontiguousarray(rgb).tobytes()
+
+    def decode(self, data):
+        magic, height, width, bands = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError('Not a raw tile')
+        return np.frombuffer(data, dtype=np.uint8, offset=self.HEADER.size).reshape(height, width, bands)
+
+
+class NpyCodec(TileCodec):
+    name = 'NPY'
+    extension = 'npy'
+
+    def encode(self, rgb):
+        npy_buffer = io.BytesIO()
+        np.save(npy_buffer, rgb, allow_pickle=False)
+        return npy_buffer.getvalue()
+
+    def decode(self, data):
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+# all codecs, in the order they are offered to the user
+CODECS = [JpegCodec, PngCodec, WebpCodec, RawCodec, NpyCodec]
+
+
+def make_codec(name, quality=90, optimize=True):
+    """
+    Creates the codec with the given name.
+    """
+    for codec in CODECS:
+        if codec.name == name:
+            return codec(quality=quality, optimize=optimize)
+    raise ValueError('Unknown codec: {}'.format(name))
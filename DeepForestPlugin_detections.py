@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+
+import numpy as np
+
+# per box: the slice it was found in, its index in that slice, the box in
+# pixels of the slice as the server returned it and in map coordinates:
+# (xg_0, yg_0) is the (xmin, ymin) corner, (xg_1, yg_1) the (xmax, ymax)
+# corner, (xg_2, yg_2) the (xmin, ymax) and (xg_3, yg_3) the (xmax, ymin)
+# corner, which only differ from the other two on rotated rasters
+RAW_COLUMNS = ('slice', 'tree', 'xmin', 'ymin', 'xmax', 'ymax', 'score', 'xg_0', 'xg_1', 'yg_0', 'yg_1',
+               'xg_2', 'yg_2', 'xg_3', 'yg_3')
+INT_COLUMNS = ('slice', 'tree')
+
+
+def empty_columns():
+    """
+    Columns without any box in them.
+    """
+    columns = {name: np.zeros(0, dtype=np.int64 if name in INT_COLUMNS else np.float64) for name in RAW_COLUMNS}
+    columns['label'] = np.zeros(0, dtype=str)
+    return columns
+
+
+def extent_geotransform(extent, sl_width, sl_height):
+    """
+    The geotransform of a north-up raster of sl_width x sl_height pixels
+    that covers the extent (x minimum, y minimum, width, height), for
+    rasters that do not have a geotransform of their own.
+    """
+    x_min, y_min, width, height = extent
+    return x_min, width / sl_width, 0.0, y_min + height, 0.0, -height / sl_height
+
+
+def pixel_to_map(geotransform, px, py):
+    """
+    Map coordinates of arrays of raster pixel coordinates, with the affine
+    GDAL geotransform, rotation and shear terms included.
+    """
+    return (geotransform[0] + px * geotransform[1] + py * geotransform[2],
+            geotransform[3] + px * geotransform[4] + py * geotransform[5])
+
+
+def boxes_to_columns(json_boxes, tile, geotransform):
+    """
+    Turns the boxes the server found in one slice, in pixel coordinates
+    of that slice, into columns with the corners of the boxes in map
+    coordinates too, see RAW_COLUMNS.
+    """
+    count = len(json_boxes)
+    if count == 0:
+        return empty_columns()
+    columns = {
+        'slice': np.full(count, tile.index, dtype=np.int64),
+        'tree': np.arange(count, dtype=np.int64),
+    }
+    for name in ('xmin', 'ymin', 'xmax', 'ymax'):
+        columns[name] = np.array([box[name] for box in json_boxes], dtype=np.float64)
+    columns['score'] = np.array([box.get('score', 1.0) for box in json_boxes], dtype=np.float64)
+    columns['label'] = np.array([str(box.get('label', 'Tree')) for box in json_boxes], dtype=str)
+
+    left, right = tile.x0 + columns['xmin'], tile.x0 + columns['xmax']
+    top, bottom = tile.y0 + columns['ymin'], tile.y0 + columns['ymax']
+    columns['xg_0'], columns['yg_0'] = pixel_to_map(geotransform, left, top)
+    columns['xg_1'], columns['yg_1'] = pixel_to_map(geotransform, right, bottom)
+    columns['xg_2'], columns['yg_2'] = pixel_to_map(geotransform, left, bottom)
+    columns['xg_3'], columns['yg_3'] = pixel_to_map(geotransform, right, top)
+    return columns
+
+
+def envelope(columns):
+    """
+    The (left, bottom, right, top) arrays of the map boxes, around all
+    four corners so it also holds on rotated rasters.
+    """
+    xs = [columns[name] for name in ('xg_0', 'xg_1', 'xg_2', 'xg_3') if name in columns]
+    ys = [columns[name] for name in ('yg_0', 'yg_1', 'yg_2', 'yg_3') if name in columns]
+    return np.minimum.reduce(xs), np.minimum.reduce(ys), np.maximum.reduce(xs), np.maximum.reduce(ys)
+
+
+def concat_columns(parts):
+    """
+    The boxes of several sets of columns, one after the other.
+    """
+    parts = [part for part in parts if len(part['slice'])]
+    if not parts:
+        return empty_columns()
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def take_rows(columns, rows):
+    """
+    The given rows of the columns, as an index array or boolean mask.
+    """
+    return {name: column[rows] for name, column in columns.items()}
+
+
+def polygon_corners(columns):
+    """
+    The x and y coordinates of the corners of every box, as (n, 4) arrays
+    in polygon order.
+    """
+    # detections stored before rotated rasters were supported only have two corners
+    x_2, y_2 = columns.get('xg_2', columns['xg_0']), columns.get('yg_2', columns['yg_1'])
+    x_3, y_3 = columns.get('xg_3', columns['xg_1']), columns.get('yg_3', columns['yg_0'])
+    return (np.stack([columns['xg_0'], x_2, columns['xg_1'], x_3], axis=1),
+            np.stack([columns['yg_0'], y_2, columns['yg_1'], y_3], axis=1))
+
+
+def columns_to_features(columns, rows=None):
+    """
+    The GeoJSON features of the output for the given rows of the columns
+    (all rows when None).
+    """
+    if rows is None:
+        rows = np.arange(len(columns['slice']))
+    corner_x, corner_y = polygon_corners(columns)
+    features = []
+    for row in rows.tolist():
+        corners = [[x, y] for x, y in zip(corner_x[row].tolist(), corner_y[row].tolist())]
+        properties = {name: columns[name][row].item()
+                      for name in ('slice', 'tree', 'xg_0', 'xg_1', 'yg_0', 'yg_1', 'xmin', 'ymin', 'xmax', 'ymax')}
+        properties['label'] = str(columns['label'][row])
+        properties['score'] = columns['score'][row].item()
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [corners + corners[:1]]
+            },
+            "properties": properties
+        })
+    return features
+
+
+def save_raw_detections(path, columns, meta):
+    """
+    Writes the columns and a dict of metadata (crs, settings) to a
+    compressed .npz file.
+    """
+    with open(path, 'wb') as raw_file:
+        np.savez_compressed(raw_file, meta=np.array(json.dumps(meta)), **columns)
+
+
+def load_raw_detections(path):
+    """
+    The columns and the metadata written by save_raw_detections().
+    """
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        columns = {name: data[name] for name in data.files if name != 'meta'}
+    return columns, meta
+
+
+def candidate_pairs(left, bottom, right, top):
+    """
+    All pairs (i, j), i < j, of boxes that may overlap, without comparing
+    every box with every other one: boxes are put in a grid of cells as
+    big as the largest box, so overlapping boxes are always in the same
+    or in neighbouring cells. Returns two index arrays.
+    """
+    count = len(left)
+    if count < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # a bit bigger than the largest box, so rounding never puts overlapping boxes two cells apart
+    cell = max(float((right - left).max()), float((top - bottom).max())) * (1 + 1e-9) + 1e-9
+    cell_x = np.floor((left - left.min()) / cell).astype(np.int64)
+    cell_y = np.floor((bottom - bottom.min()) / cell).astype(np.int64)
+    rows = int(cell_y.max()) + 3
+    keys = cell_x * rows + cell_y + 1
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    # half of the neighbourhood is enough, the other half are the same pairs the other way around
+    for offset in (0, rows - 1, rows, rows + 1, 1):
+        starts = np.searchsorted(sorted_keys, sorted_keys + offset, side='left')
+        stops = np.searchsorted(sorted_keys, sorted_keys + offset, side='right')
+        if offset == 0:
+            starts = np.arange(count) + 1  # only later boxes in the same cell
+        lengths = np.maximum(stops - starts, 0)
+        total = int(lengths.sum())
+        if total == 0:
+            continue
+        firsts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        pairs_i.append(np.repeat(order, lengths))
+        pairs_j.append(order[np.arange(total) + firsts])
+    if not pairs_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pair_i, pair_j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    return np.minimum(pair_i, pair_j), np.maximum(pair_i, pair_j)
+
+
+def overlap_duplicates(x_0, y_0, x_1, y_1):
+    """
+    Removes boxes that are the same tree found twice, with the rule the
+    plugin always used: two boxes overlap when the center of one lies in
+    the other, and of two overlapping boxes the smaller one (the first
+    one, when equally big) is removed. Boxes are taken in order; a box
+    that is removed no longer removes boxes after it.
+
+    Returns a boolean mask of the boxes that are kept and the number of
+    overlaps that were resolved. Only the candidate_pairs() are checked,
+    instead of every box against every other one.
+    """
+    left, right = np.minimum(x_0, x_1), np.maximum(x_0, x_1)
+    bottom, top = np.minimum(y_0, y_1), np.maximum(y_0, y_1)
+    mid_x, mid_y = (left + right) / 2, (bottom + top) / 2
+    area = (right - left) * (top - bottom)
+    keep = np.ones(len(left), dtype=bool)
+
+    def center_in(box, other):
+        return ((left[box] <= mid_x[other]) & (mid_x[other] <= right[box]) &
+                (bottom[box] <= mid_y[other]) & (mid_y[other] <= top[box]))
+
+    pair_i, pair_j = candidate_pairs(left, bottom, right, top)
+    over = center_in(pair_i, pair_j) | center_in(pair_j, pair_i)
+    pair_i, pair_j = pair_i[over], pair_j[over]
+    order = np.lexsort((pair_j, pair_i))
+
+    dupe_count = 0
+    for i, j in zip(pair_i[order].tolist(), pair_j[order].tolist()):
+        if keep[i] and keep[j]:
+            dupe_count = dupe_count + 1
+            if area[i] > area[j]:
+                keep[j] = False
+            else:
+                keep[i] = False
+    return keep, dupe_count
+
+
+def pair_ious(x_0, y_0, x_1, y_1):
+    """
+    The candidate_pairs() of the boxes and their intersection over union.
+    """
+    left, right = np.minimum(x_0, x_1), np.maximum(x_0, x_1)
+    bottom, top = np.minimum(y_0, y_1), np.maximum(y_0, y_1)
+    pair_i, pair_j = candidate_pairs(left, bottom, right, top)
+    width = np.minimum(right[pair_i], right[pair_j]) - np.maximum(left[pair_i], left[pair_j])
+    height = np.minimum(top[pair_i], top[pair_j]) - np.maximum(bottom[pair_i], bottom[pair_j])
+    inter = np.clip(width, 0, None) * np.clip(height, 0, None)
+    area = (right - left) * (top - bottom)
+    return pair_i, pair_j, inter / np.maximum(area[pair_i] + area[pair_j] - inter, 1e-12)
+
+
+def suppress_pairs(scores, pair_i, pair_j, keep, owner=None):
+    """
+    Greedy non-maximum suppression over pairs of boxes that overlap too
+    much: going from the highest score down, every box that is kept
+    removes the lower scoring boxes it is paired with. Clears the removed
+    boxes in the boolean mask keep and returns it. When an owner array is
+    given, the index of the box that removed it is stored for every
+    removed box.
+    """
+    if len(pair_i) == 0:
+        return keep
+    # point every pair from the higher to the lower ranked box
+    rank = np.empty(len(scores), dtype=np.int64)
+    rank[np.argsort(-scores, kind='stable')] = np.arange(len(scores))
+    swap = rank[pair_i] > rank[pair_j]
+    high = np.where(swap, pair_j, pair_i)
+    low = np.where(swap, pair_i, pair_j)
+    order = np.argsort(rank[high], kind='stable')
+    high, low = high[order], low[order]
+    bounds = np.flatnonzero(np.diff(high)) + 1
+    for box, lower in zip(high[np.r_[0, bounds]].tolist(), np.split(low, bounds)):
+        if keep[box]:
+            if owner is not None:
+                lower = lower[keep[lower]]
+                owner[lower] = box
+            keep[lower] = False
+    return keep
+
+
+def iou_suppress(x_0, y_0, x_1, y_1, scores, iou_threshold):
+    """
+    Greedy non-maximum suppression: every box that is kept removes the
+    lower scoring boxes it overlaps with an intersection over union above
+    iou_threshold. Returns a boolean mask of the boxes that are kept.
+    """
+    pair_i, pair_j, iou = pair_ious(x_0, y_0, x_1, y_1)
+    over = iou > iou_threshold
+    return suppress_pairs(scores, pair_i[over], pair_j[over], np.ones(len(scores), dtype=bool))
+
+
+def moved_pixels(columns, moved):
+    """
+    The xmin, ymin, xmax and ymax columns of boxes whose map corners were
+    moved to those of moved, in pixels of their own slice. The pixel to
+    map transform is taken from the corners of every box itself, so no
+    geotransform or slice offset is needed.
+    """
+    x_0, y_0 = columns['xg_0'], columns['yg_0']
+    # detections stored before rotated rasters were supported only have two corners
+    x_2, y_2 = columns.get('xg_2', x_0), columns.get('yg_2', columns['yg_1'])
+    x_3, y_3 = columns.get('xg_3', columns['xg_1']), columns.get('yg_3', y_0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # map offset of one pixel to the right (a) and one pixel down (b)
+        width, height = columns['xmax'] - columns['xmin'], columns['ymax'] - columns['ymin']
+        a_x, a_y = (x_3 - x_0) / width, (y_3 - y_0) / width
+        b_x, b_y = (x_2 - x_0) / height, (y_2 - y_0) / height
+        det = a_x * b_y - b_x * a_y
+        valid = np.isfinite(det) & (det != 0)
+        det = np.where(valid, det, 1.0)
+
+        def to_pixels(d_x, d_y):
+            return (np.where(valid, (b_y * d_x - b_x * d_y) / det, 0.0),
+                    np.where(valid, (a_x * d_y - a_y * d_x) / det, 0.0))
+
+        d_xmin, d_ymin = to_pixels(moved['xg_0'] - x_0, moved['yg_0'] - y_0)
+        d_xmax, d_ymax = to_pixels(moved['xg_1'] - columns['xg_1'], moved['yg_1'] - columns['yg_1'])
+    return {'xmin': columns['xmin'] + d_xmin, 'ymin': columns['ymin'] + d_ymin,
+            'xmax': columns['xmax'] + d_xmax, 'ymax': columns['ymax'] + d_ymax}
+
+
+def merge_overlapping(columns, iou_threshold, fuse=False):
+    """
+    Cross-slice non-maximum suppression: of boxes that overlap with an
+    intersection over union above iou_threshold, only the one with the
+    highest score is kept. With fuse, the kept box is moved to the score
+    weighted average of the map corners of all boxes it removed and
+    itself, and gets their mean score (weighted box fusion). Its pixel
+    columns are moved along, in pixels of the slice of the kept box.
+
+    Returns the merged columns and the number of boxes that were removed.
+    """
+    count = len(columns['slice'])
+    scores = columns['score']
+    pair_i, pair_j, iou = pair_ious(*envelope(columns))
+    over = iou > iou_threshold
+    owner = np.arange(count)
+    keep = suppress_pairs(scores, pair_i[over], pair_j[over], np.ones(count, dtype=bool), owner)
+    if fuse and not keep.all():
+        fused = dict(columns)
+        weights = np.maximum(scores, 1e-6)
+        total = np.maximum(np.bincount(owner, weights=weights, minlength=count), 1e-12)  # 0 for removed boxes
+        for name in ('xg_0', 'xg_1', 'xg_2', 'xg_3', 'yg_0', 'yg_1', 'yg_2', 'yg_3'):
+            if name in columns:
+                fused[name] = np.bincount(owner, weights=weights * columns[name], minlength=count) / total
+        fused['score'] = (np.bincount(owner, weights=scores, minlength=count) /
+                          np.maximum(np.bincount(owner, minlength=count), 1))
+        fused.update(moved_pixels(columns, fused))
+        columns = fused
+    return take_rows(columns, keep), count - int(keep.sum())
+
+
+def refilter(columns, thresh, iou_threshold):
+    """
+    The rows of the raw detections with at least the given score that are
+    left after suppressing overlapping boxes across slices.
+    """
+    rows = np.flatnonzero(columns['score'] >= thresh)
+    left, bottom, right, top = envelope(take_rows(columns, rows))
+    return rows[iou_suppress(left, bottom, right, top, columns['score'][rows], iou_threshold)]
+
+
+def sweep(columns, thresholds, iou_thresholds):
+    """
+    Yields (thresh, iou_threshold, rows) for every combination, like
+    refilter() but the overlaps are only computed once.
+    """
+    scores = columns['score']
+    pair_i, pair_j, iou = pair_ious(*envelope(columns))
+    for thresh in thresholds:
+        active = scores >= thresh
+        active_pairs = active[pair_i] & active[pair_j]
+        for iou_threshold in iou_thresholds:
+            over = active_pairs & (iou > iou_threshold)
+            keep = suppress_pairs(scores, pair_i[over], pair_j[over], active.copy())
+            yield thresh, iou_threshold, np.flatnonzero(keep)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import hashlib
+import json
+import os
+
+
+class TileJournal(object):
+    """
+    An append-only log of finished slices and the boxes the detector
+    found in them, one JSON object per line, so a cancelled or crashed
+    job can pick up where it stopped.
+
+    The first line holds the job description: the raster, the slicing and
+    everything else that changes the boxes. Its hash is part of the file
+    name, so a job only ever resumes from a journal of the same job.
+    """
+
+    def __init__(self, folder, job):
+        self.job = job
+        digest = hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(folder, 'journal_{}.jsonl'.format(digest))
+        self._file = None
+
+    def load(self):
+        """
+        The boxes of every slice in the journal, by slice index. A last
+        line that was cut off by a crash is ignored.
+        """
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'rt') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if 'slice' in entry:
+                    done[entry['slice']] = entry['boxes']
+        return done
+
+    def open(self, resume):
+        """
+        Opens the journal for appending; unless resuming, any old journal
+        of the same job is started over.
+        """
+        if resume and os.path.exists(self.path):
+            self._truncate_partial_line()
+            self._file = open(self.path, 'at')
+        else:
+            self._file = open(self.path, 'wt')
+            self._write({'job': self.job})
+
+    def record(self, tile, boxes):
+        self._write({'slice': tile.index, 'x0': tile.x0, 'y0': tile.y0, 'boxes': boxes})
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()  # a crash loses at most the slice being written
+
+    def _truncate_partial_line(self):
+        with open(self.path, 'rb+') as journal_file:
+            data = journal_file.read()
+            if data and not data.endswith(b'\n'):
+                journal_file.truncate(data.rfind(b'\n') + 1)
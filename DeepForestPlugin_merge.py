@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import numpy as np
+
+from .DeepForestPlugin_detections import (candidate_pairs, concat_columns, empty_columns, envelope, pixel_to_map,
+                                          take_rows)
+
+
+def intersecting(left, bottom, right, top, pair_i, pair_j):
+    """
+    Which of the pairs of boxes intersect or touch.
+    """
+    return ((left[pair_i] <= right[pair_j]) & (left[pair_j] <= right[pair_i]) &
+            (bottom[pair_i] <= top[pair_j]) & (bottom[pair_j] <= top[pair_i]))
+
+
+def connected_components(count, pair_i, pair_j):
+    """
+    A label per item, the same for items that are connected through the
+    pairs: the lowest index in the group.
+    """
+    labels = np.arange(count)
+    while len(pair_i):
+        low = np.minimum(labels[pair_i], labels[pair_j])
+        merged = labels.copy()
+        np.minimum.at(merged, pair_i, low)
+        np.minimum.at(merged, pair_j, low)
+        merged = merged[merged]
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+    return labels
+
+
+class SeamMerger(object):
+    """
+    Merges the trees of slices as the slices are finished, instead of all
+    at once at the end. Boxes of a slice can only be duplicates of boxes
+    of the slices it overlaps, so a box is final as soon as every slice
+    its envelope touches is finished. Finished boxes are merged in groups
+    of boxes that touch each other, with the merge function that takes
+    and returns columns, plus the number of boxes removed. Groups never
+    interact, so the result is the same as merging everything at once.
+
+    Only the boxes along the seams of unfinished slices are held; the
+    others are returned by finish() straight away.
+    """
+
+    def __init__(self, tiles, geotransform, merge):
+        self.merge = merge
+        self.removed = 0
+        self.pending = empty_columns()
+
+        # the map envelopes of the slices and the slices each one overlaps
+        px_0 = np.array([tile.x0 for tile in tiles], dtype=np.float64)
+        py_0 = np.array([tile.y0 for tile in tiles], dtype=np.float64)
+        px_1 = px_0 + np.array([tile.width for tile in tiles], dtype=np.float64)
+        py_1 = py_0 + np.array([tile.height for tile in tiles], dtype=np.float64)
+        corners = [pixel_to_map(geotransform, px, py) for px, py in ((px_0, py_0), (px_1, py_1),
+                                                                     (px_0, py_1), (px_1, py_0))]
+        self.tile_left = np.minimum.reduce([x for x, _ in corners])
+        self.tile_bottom = np.minimum.reduce([y for _, y in corners])
+        self.tile_right = np.maximum.reduce([x for x, _ in corners])
+        self.tile_top = np.maximum.reduce([y for _, y in corners])
+        pair_i, pair_j = candidate_pairs(self.tile_left, self.tile_bottom, self.tile_right, self.tile_top)
+        touching = intersecting(self.tile_left, self.tile_bottom, self.tile_right, self.tile_top, pair_i, pair_j)
+        self.neighbours = {tile.index: set() for tile in tiles}
+        for i, j in zip(pair_i[touching].tolist(), pair_j[touching].tolist()):
+            self.neighbours[tiles[i].index].add(tiles[j].index)
+            self.neighbours[tiles[j].index].add(tiles[i].index)
+        self.position = {tile.index: position for position, tile in enumerate(tiles)}
+        self.unfinished = set(self.neighbours)
+
+    def finish(self, index, columns=None):
+        """
+        Marks the slice as finished, with the boxes that were found in it,
+        and returns the merged boxes that are final now.
+        """
+        self.unfinished.discard(index)
+        if columns is not None and len(columns['slice']):
+            self.pending = concat_columns([self.pending, columns])
+        return self._flush(everything=False)
+
+    def close(self):
+        """
+        Merges and returns all boxes that are left, e.g. of slices next to
+        slices that failed or were never done because of a cancel.
+        """
+        self.unfinished = set()
+        return self._flush(everything=True)
+
+    def _flush(self, everything):
+        pending = self.pending
+        count = len(pending['slice'])
+        if count == 0:
+            return empty_columns()
+        left, bottom, right, top = envelope(pending)
+
+        ready = np.ones(count, dtype=bool)
+        if not everything:
+            blocking = set()
+            for index in np.unique(pending['slice']).tolist():
+                blocking |= self.neighbours[index] & self.unfinished
+            for index in blocking:
+                position = self.position[index]
+                ready &= ~((left <= self.tile_right[position]) & (self.tile_left[position] <= right) &
+                           (bottom <= self.tile_top[position]) & (self.tile_bottom[position] <= top))
+            if not ready.any():
+                return empty_columns()
+
+        # a group of touching boxes is final when all its boxes are
+        pair_i, pair_j = candidate_pairs(left, bottom, right, top)
+        touching = intersecting(left, bottom, right, top, pair_i, pair_j)
+        labels = connected_components(count, pair_i[touching], pair_j[touching])
+        group_ready = np.ones(count, dtype=bool)
+        group_ready[labels[~ready]] = False
+        final = group_ready[labels]
+
+        self.pending = take_rows(pending, ~final)
+        boxes = take_rows(pending, final)
+        # merge in slice order, like merging all boxes at once would
+        boxes, removed = self.merge(take_rows(boxes, np.lexsort((boxes['tree'], boxes['slice']))))
+        self.removed = self.removed + removed
+        return boxes
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import functools
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+# how often a waiting loop checks whether the user cancelled, in seconds
+CANCEL_POLL_INTERVAL = 0.2
+
+_END = object()
+
+
+def run_ordered(func, items, workers, is_canceled, queue_depth=2, submit=None):
+    """
+    Calls func on every item in a pool of worker threads and yields
+    (item, future) pairs in the order of the items, as soon as the future
+    is done. Items are pulled lazily: at most workers * queue_depth are in
+    flight, so a slow consumer does not buffer the whole input.
+
+    When submit is given, it is called with each item instead and has to
+    return a Future, e.g. of a coroutine running on an asyncio loop; func
+    is then not used. With a single worker and no submit, everything runs
+    on the calling thread. Stops, dropping pending work, as soon as
+    is_canceled() returns True.
+    """
+    if workers <= 1 and submit is None:
+        for item in items:
+            if is_canceled():
+                return
+            future = Future()
+            try:
+                future.set_result(func(item))
+            except Exception as ex:
+                future.set_exception(ex)
+            yield item, future
+        return
+
+    pool = None
+    if submit is None:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        submit = functools.partial(pool.submit, func)
+    pending = deque()
+    items = iter(items)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < workers * queue_depth:
+                if is_canceled():
+                    return
+                item = next(items, _END)
+                if item is _END:
+                    exhausted = True
+                    break
+                pending.append((item, submit(item)))
+            if not pending:
+                return
+
+            item, future = pending[0]
+            try:
+                future.exception(timeout=CANCEL_POLL_INTERVAL)
+            except TimeoutError:
+                if is_canceled():
+                    return
+                continue
+            pending.popleft()
+            yield item, future
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class BatchSizer(object):
+    """
+    Picks how many slices go into one request. With a fixed size that is
+    all there is to it. Otherwise the time of every request is recorded
+    and fitted as overhead + size * per_slice; the next batch is made
+    just big enough that the fixed overhead is at most overhead_share of
+    the request. The first batches have a few different sizes so there is
+    something to fit, and the warm-up sizes are repeated until replies of
+    at least two different sizes are in. When the fit finds no cost per
+    slice, the size grows to twice the largest one measured.
+    """
+
+    WARMUP = (1, 2, 4, 1, 2, 4)
+    HISTORY = 50
+
+    def __init__(self, fixed=None, max_size=32, overhead_share=0.1):
+        self.fixed = fixed
+        self.max_size = max_size
+        self.overhead_share = overhead_share
+        self.supported = True
+        self.requests = 0
+        self._samples = deque(maxlen=self.HISTORY)
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    def next_size(self):
+        with self._lock:
+            if not self.supported:
+                return 1
+            if self.fixed is not None:
+                return self.fixed
+            if self._issued < len(self.WARMUP) or len({size for size, _ in self._samples}) < 2:
+                self._issued = self._issued + 1
+                return min(self.max_size, self.WARMUP[(self._issued - 1) % len(self.WARMUP)])
+            overhead, per_slice = self._fit()
+            if per_slice <= 0:
+                return min(self.max_size, 2 * max(size for size, _ in self._samples))
+            size = math.ceil(overhead * (1 - self.overhead_share) / (self.overhead_share * per_slice))
+            return max(1, min(self.max_size, size))
+
+    def record(self, size, elapsed):
+        with self._lock:
+            self.requests = self.requests + 1
+            self._samples.append((size, elapsed))
+
+    def _fit(self):
+        if not self._samples:
+            return 0.0, 0.0
+        sizes = [size for size, _ in self._samples]
+        times = [elapsed for _, elapsed in self._samples]
+        mean_size = sum(sizes) / len(sizes)
+        mean_time = sum(times) / len(times)
+        spread = sum((size - mean_size) ** 2 for size in sizes)
+        if spread == 0:
+            return 0.0, mean_time / mean_size
+        per_slice = sum((size - mean_size) * (t - mean_time) for size, t in zip(sizes, times)) / spread
+        return max(0.0, mean_time - per_slice * mean_size), per_slice
+
+    def summary(self):
+        with self._lock:
+            overhead, per_slice = self._fit()
+        return {
+            'batch_size': 'auto' if self.fixed is None else self.fixed,
+            'supported': self.supported,
+            'requests': self.requests,
+            'overhead_seconds': round(overhead, 3),
+            'seconds_per_slice': round(per_slice, 3),
+        }
+
+
+def batched(items, sizer):
+    """
+    Groups items into lists of the size the sizer asks for at that moment.
+    """
+    batch = []
+    size = sizer.next_size()
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+            size = sizer.next_size()
+    if batch:
+        yield batch
+
+
+def unbatch(results, key):
+    """
+    Turns (batch, future) pairs, where the future holds a dict of results
+    by key(item), back into (item, future) pairs for every item.
+    """
+    for batch, future in results:
+        error = future.exception()
+        for item in batch:
+            item_future = Future()
+            if error is not None:
+                item_future.set_exception(error)
+            else:
+                item_future.set_result(future.result()[key(item)])
+            yield item, item_future
+
+
+def _timed(func, arg):
+    """
+    Calls func(arg) and also returns how long that took; runs in worker
+    processes, so it has to live at module level.
+    """
+    start = time.perf_counter()
+    result = func(arg)
+    return result, time.perf_counter() - start
+
+
+class StageStats(object):
+    """
+    Time spent by one pipeline stage working, waiting for input from the
+    stage before it (starved) and waiting for room in the queue after it
+    (blocked).
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, busy=0.0, starved=0.0, blocked=0.0, items=0):
+        with self._lock:
+            self.busy = self.busy + busy
+            self.starved = self.starved + starved
+            self.blocked = self.blocked + blocked
+            self.items = self.items + items
+
+    def as_dict(self, wall_time):
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': round(self.busy, 3),
+            'starved_seconds': round(self.starved, 3),
+            'blocked_seconds': round(self.blocked, 3),
+            'utilization': round(self.busy / max(wall_time * self.workers, 1e-9), 3),
+        }
+
+
+class TilePipeline(object):
+    """
+    Three stages connected by bounded queues, so reading, encoding and
+    uploading all happen at the same time:
+
+    - a reader thread that pulls (tile, array) pairs from the raster,
+    - a process pool that encodes the arrays (Pillow holds the GIL while
+      encoding large images, so threads would not run in parallel),
+    - a pool of network threads that send the encoded slices.
+
+    Memory is capped by the queue depth. The per-stage statistics show
+    which of the three is the bottleneck on a given machine.
+    """
+
+    def __init__(self, items, encode, send, encoders, senders, is_canceled, queue_depth=4):
+        self.items = items
+        self.encode = encode
+        self.send = send
+        self.encoders = encoders
+        self.senders = senders
+        self.is_canceled = is_canceled
+        self.read_queue = queue.Queue(maxsize=queue_depth)
+        self.send_queue = queue.Queue(maxsize=queue_depth + encoders)
+        self.result_queue = queue.Queue()
+        self.stop = threading.Event()
+        self.stats = [StageStats('read'), StageStats('encode', encoders), StageStats('send', senders)]
+        self.wall_time = 0.0
+
+    def run(self):
+        """
+        Yields (tile, future) pairs in tile order as their results arrive.
+        Raises the error of the read or encode stage when one of them fails,
+        e.g. on a read error or a broken process pool.
+        """
+        start = time.perf_counter()
+        context = multiprocessing_context()
+        pool = ProcessPoolExecutor(max_workers=self.encoders, mp_context=context)
+        threads = [threading.Thread(target=self._read_stage, daemon=True),
+                   threading.Thread(target=self._encode_stage, args=(pool,), daemon=True)]
+        threads += [threading.Thread(target=self._send_stage, daemon=True) for _ in range(self.senders)]
+        for thread in threads:
+            thread.start()
+
+        finished = {}
+        next_index = 0
+        done_senders = 0
+        try:
+            while done_senders < self.senders:
+                try:
+                    order, tile, future = self.result_queue.get(timeout=CANCEL_POLL_INTERVAL)
+                except queue.Empty:
+                    if self.is_canceled():
+                        return
+                    continue
+                if tile is None:
+                    if future is not None:
+                        raise future
+                    done_senders = done_senders + 1
+                    continue
+                finished[order] = (tile, future)
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index = next_index + 1
+                if self.is_canceled():
+                    return
+        finally:
+            self.stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.wall_time = time.perf_counter() - start
+
+    def summary(self):
+        """
+        Per-stage statistics, with the stage that was busiest named as the
+        bottleneck.
+        """
+        stages = {stats.name: stats.as_dict(self.wall_time) for stats in self.stats}
+        bottleneck = max(stages, key=lambda name: stages[name]['utilization'])
+        return {'wall_seconds': round(self.wall_time, 3), 'bottleneck': bottleneck, 'stages': stages}
+
+    def _put(self, target, item, stats):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=CANCEL_POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        stats.add(blocked=time.perf_counter() - start)
+
+    def _get(self, source, stats):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                item = source.get(timeout=CANCEL_POLL_INTERVAL)
+                stats.add(starved=time.perf_counter() - start)
+                return item
+            except queue.Empty:
+                pass
+        return _END
+
+    def _read_stage(self):
+        stats = self.stats[0]
+        order = 0
+        items = iter(self.items)
+        try:
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                item = next(items, _END)
+                stats.add(busy=time.perf_counter() - start, items=0 if item is _END else 1)
+                if item is _END:
+                    break
+                self._put(self.read_queue, (order, item), stats)
+                order = order + 1
+        except Exception as ex:
+            self.result_queue.put((None, None, ex))
+        finally:
+            self._put(self.read_queue, _END, stats)
+
+    def _encode_stage(self, pool):
+        stats = self.stats[1]
+        try:
+            while True:
+                item = self._get(self.read_queue, stats)
+                if item is _END:
+                    break
+                order, (tile, part) = item
+                future = pool.submit(_timed, self.encode, part)
+                self._put(self.send_queue, (order, tile, future), stats)
+        except Exception as ex:
+            self.result_queue.put((None, None, ex))
+        finally:
+            for _ in range(self.senders):
+                self._put(self.send_queue, _END, stats)
+
+    def _send_stage(self):
+        stats = self.stats[2]
+        try:
+            while True:
+                item = self._get(self.send_queue, stats)
+                if item is _END:
+                    break
+                order, tile, encoded = item
+                result = Future()
+                try:
+                    data, encode_time = encoded.result()
+                    self.stats[1].add(busy=encode_time, items=1)
+                    start = time.perf_counter()
+                    try:
+                        result.set_result(self.send(tile, data))
+                    finally:
+                        stats.add(busy=time.perf_counter() - start, items=1)
+                except Exception as ex:
+                    result.set_exception(ex)
+                self.result_queue.put((order, tile, result))
+        finally:
+            self.result_queue.put((None, None, None))
+
+
+def multiprocessing_context():
+    """
+    A spawn context that starts the encoder processes with the python
+    interpreter that ships with QGIS, instead of the QGIS executable that
+    sys.executable points to on Windows.
+    """
+    context = multiprocessing.get_context('spawn')
+    python = os.path.join(sys.exec_prefix, 'pythonw.exe' if sys.platform == 'win32' else 'bin/python3')
+    if os.path.basename(sys.executable).lower().startswith('qgis') and os.path.exists(python):
+        context.set_executable(python)
+    return context
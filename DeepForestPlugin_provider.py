@@ -32,6 +32,8 @@ __revision__ = '$Format:%H$'
 
 from qgis.core import QgsProcessingProvider
 from .DeepForestPlugin_algorithm import DeepForestPluginAlgorithm
+from .DeepForestPlugin_refilter import DeepForestPluginRefilterAlgorithm
+from .DeepForestPlugin_sweep import DeepForestPluginSweepAlgorithm
 
 
 class DeepForestPluginProvider(QgsProcessingProvider):
@@ -54,9 +56,24 @@ class DeepForestPluginProvider(QgsProcessingProvider):
         Loads all algorithms belonging to this provider.
         """
         self.addAlgorithm(DeepForestPluginAlgorithm())
+        self.addAlgorithm(DeepForestPluginRefilterAlgorithm())
+        self.addAlgorithm(DeepForestPluginSweepAlgorithm())
         # add additional algorithms here
         # self.addAlgorithm(MyOtherAlgorithm())
 
+    def supportedOutputVectorLayerExtensions(self):
+        """
+        Returns the file formats the tree layers can be written to: formats
+        with a spatial index, which large outputs need to be usable.
+        """
+        return ['gpkg', 'fgb']
+
+    def defaultVectorFileExtension(self, hasGeometry=True):
+        """
+        Returns the file format tree layers are written to by default.
+        """
+        return 'gpkg'
+
     def id(self):
         """
         Returns the unique provider id, used for identifying the provider. This
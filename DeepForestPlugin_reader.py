@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import math
+from collections import namedtuple
+
+import numpy as np
+from osgeo import gdal
+
+# one slice of the raster, in pixel coordinates (overlap included)
+Tile = namedtuple('Tile', ['index', 'x0', 'y0', 'width', 'height'])
+
+
+def snap_to_block(slice_size, overlap, block):
+    """
+    Rounds a slice size to a whole number of blocks, and the overlap too
+    when it spans at least half a block. Blocks that are larger than the
+    slice (e.g. full-width strips) are left alone.
+    """
+    if block <= 1 or block >= slice_size:
+        return slice_size, overlap
+    slice_size = max(1, round(slice_size / block)) * block
+    if overlap >= block / 2:
+        overlap = round(overlap / block) * block
+    return slice_size, overlap
+
+
+def excess_green(rgb):
+    """
+    Excess Green index (2g - r - b) on chromatic coordinates, in [-1, 2].
+    """
+    total = rgb.sum(axis=2)
+    total[total == 0] = 1
+    r, g, b = (rgb[:, :, i] / total for i in range(3))
+    return 2 * g - r - b
+
+
+def green_leaf_index(rgb):
+    """
+    Green Leaf Index (2G - R - B) / (2G + R + B), in [-1, 1].
+    """
+    r, g, b = (rgb[:, :, i] for i in range(3))
+    total = 2 * g + r + b
+    total[total == 0] = 1
+    return (2 * g - r - b) / total
+
+
+def visible_atmospherically_resistant_index(rgb):
+    """
+    VARI (G - R) / (G + R - B), clipped to [-1, 1].
+    """
+    r, g, b = (rgb[:, :, i] for i in range(3))
+    total = g + r - b
+    total[total == 0] = 1
+    return np.clip((g - r) / total, -1, 1)
+
+
+VEGETATION_INDICES = {
+    'ExG': excess_green,
+    'GLI': green_leaf_index,
+    'VARI': visible_atmospherically_resistant_index,
+}
+
+
+class TileReader(object):
+    """
+    Cuts a GDAL dataset into overlapping slices and reads them one at a
+    time, so memory use is bounded by the slice size instead of the size
+    of the whole raster.
+    """
+
+    BANDS = (1, 2, 3)
+
+    def __init__(self, ds, slice_size, slice_overlap=1.1, reuse_buffer=True, block_aligned=False):
+        self.ds = ds
+        self.width = ds.RasterXSize
+        self.height = ds.RasterYSize
+        self.slice_overlap = slice_overlap  # percentage overlap
+
+        part_count_v = math.ceil(self.height / slice_size)
+        part_count_h = math.ceil(self.width / slice_size)
+        self.slice_v = math.ceil(self.height / part_count_v)
+        self.slice_h = math.ceil(self.width / part_count_h)
+        self.overlap_v = math.ceil(self.slice_v * slice_overlap) - self.slice_v
+        self.overlap_h = math.ceil(self.slice_h * slice_overlap) - self.slice_h
+
+        self.block_aligned = block_aligned
+        if block_aligned:
+            block_h, block_w = self.block_size()
+            self.slice_v, self.overlap_v = snap_to_block(self.slice_v, self.overlap_v, block_h)
+            self.slice_h, self.overlap_h = snap_to_block(self.slice_h, self.overlap_h, block_w)
+
+        self.total_parts = math.ceil(self.height / self.slice_v) * math.ceil(self.width / self.slice_h)
+
+        # a single flat buffer, big enough for the largest slice, that every
+        # read is written into when the caller does not keep the arrays
+        self.reuse_buffer = reuse_buffer
+        self._buffer = None
+
+        # low resolution validity mask and vegetation index, see load_mask()
+        # and load_vegetation()
+        self._mask = None
+        self._vegetation = None
+        self._overview_scale = (1.0, 1.0)
+
+    def block_size(self):
+        """
+        Returns the natural (height, width) block size of the first band.
+        """
+        block_w, block_h = self.ds.GetRasterBand(self.BANDS[0]).GetBlockSize()
+        return block_h, block_w
+
+    def load_mask(self, max_size=2048):
+        """
+        Reads the GDAL mask band (nodata, alpha band or mask file) of the
+        raster at a resolution of at most max_size pixels per side, which
+        GDAL serves from the overviews when they exist. Returns False when
+        every pixel of the raster is valid.
+        """
+        band = self.ds.GetRasterBand(self.BANDS[0])
+        if band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+            self._mask = None
+            return False
+
+        buf_w, buf_h = self._overview_size(max_size)
+        mask = band.GetMaskBand().ReadAsArray(0, 0, self.width, self.height,
+                                              buf_xsize=buf_w, buf_ysize=buf_h)
+        self._mask = mask > 0
+        return True
+
+    def load_vegetation(self, index='ExG', max_size=2048):
+        """
+        Computes a vegetation index over an overview of the raster, at most
+        max_size pixels per side, to pre-screen slices for trees.
+        """
+        buf_w, buf_h = self._overview_size(max_size)
+        rgb = np.dstack([self.ds.GetRasterBand(b).ReadAsArray(0, 0, self.width, self.height,
+                                                                buf_xsize=buf_w, buf_ysize=buf_h)
+                         for b in self.BANDS]).astype(np.float32)
+        self._vegetation = VEGETATION_INDICES[index](rgb)
+
+    def vegetation_fraction(self, tile, threshold):
+        """
+        Fraction of pixels in a slice whose vegetation index, as loaded by
+        load_vegetation(), exceeds the threshold.
+        """
+        if self._vegetation is None:
+            return 1.0
+        window = self._overview_window(self._vegetation, self._overview_scale, tile)
+        if window.size == 0:
+            return 0.0
+        return float(np.count_nonzero(window > threshold)) / window.size
+
+    def valid_fraction(self, tile):
+        """
+        Fraction of valid (not nodata, not transparent) pixels in a slice,
+        estimated from the mask loaded by load_mask().
+        """
+        if self._mask is None:
+            return 1.0
+        window = self._overview_window(self._mask, self._overview_scale, tile)
+        if window.size == 0:
+            return 0.0
+        return float(np.count_nonzero(window)) / window.size
+
+    def _overview_size(self, max_size):
+        scale = max(1.0, max(self.width, self.height) / max_size)
+        buf_w = max(1, int(self.width / scale))
+        buf_h = max(1, int(self.height / scale))
+        self._overview_scale = (buf_h / self.height, buf_w / self.width)
+        return buf_w, buf_h
+
+    @staticmethod
+    def _overview_window(overview, scale, tile):
+        scale_y, scale_x = scale
+        oy0 = int(tile.y0 * scale_y)
+        ox0 = int(tile.x0 * scale_x)
+        oy1 = max(oy0 + 1, math.ceil((tile.y0 + tile.height) * scale_y))
+        ox1 = max(ox0 + 1, math.ceil((tile.x0 + tile.width) * scale_x))
+        return overview[oy0:oy1, ox0:ox1]
+
+    def tiles(self):
+        """
+        Yields the slices row by row, clipped to the raster bounds.
+        """
+        index = 0
+        for y0 in range(0, self.height, self.slice_v):
+            for x0 in range(0, self.width, self.slice_h):
+                y_max = min(y0 + self.slice_v + self.overlap_v, self.height)
+                x_max = min(x0 + self.slice_h + self.overlap_h, self.width)
+                yield Tile(index, x0, y0, x_max - x0, y_max - y0)
+                index = index + 1
+
+    def read(self, tile):
+        """
+        Reads the RGB window of a single slice as a contiguous (h, w, 3)
+        uint8 array, using one pixel-interleaved GDAL call for all bands.
+        When reuse_buffer is set, the returned array is only valid until
+        the next call to read().
+        """
+        out = self._output(tile)
+        try:
+            return self.ds.ReadAsArray(tile.x0, tile.y0, tile.width, tile.height,
+                                       buf_obj=out,
+                                       buf_type=gdal.GDT_Byte,
+                                       band_list=list(self.BANDS),
+                                       interleave='pixel')
+        except TypeError:
+            # GDAL < 3.7 has no interleave argument, fall back to the raw buffer
+            raw = self.ds.ReadRaster(tile.x0, tile.y0, tile.width, tile.height,
+                                     buf_type=gdal.GDT_Byte,
+                                     band_list=list(self.BANDS),
+                                     buf_pixel_space=len(self.BANDS),
+                                     buf_line_space=len(self.BANDS) * tile.width,
+                                     buf_band_space=1)
+            return np.frombuffer(raw, dtype=np.uint8).reshape(tile.height, tile.width, len(self.BANDS))
+
+    def _output(self, tile):
+        size = tile.height * tile.width * len(self.BANDS)
+        if not self.reuse_buffer:
+            return np.empty((tile.height, tile.width, len(self.BANDS)), dtype=np.uint8)
+        if self._buffer is None or self._buffer.size < size:
+            max_h = min(self.slice_v + self.overlap_v, self.height)
+            max_w = min(self.slice_h + self.overlap_h, self.width)
+            self._buffer = np.empty(max(size, max_h * max_w * len(self.BANDS)), dtype=np.uint8)
+        return self._buffer[:size].reshape(tile.height, tile.width, len(self.BANDS))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import datetime
+import json
+from .DeepForestPlugin_detections import load_raw_detections, refilter
+from .DeepForestPlugin_writers import write_geojson
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (QgsProcessingAlgorithm,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFolderDestination,
+                       QgsProcessingParameterNumber)
+
+
+class DeepForestPluginRefilterAlgorithm(QgsProcessingAlgorithm):
+    """
+    Applies another score threshold and overlap threshold to the raw
+    detections stored by the Detect Trees algorithm, without sending
+    anything to the tree detector again.
+    """
+
+    OUTPUT = 'OUTPUT'
+    INPUT = 'INPUT'
+    INPUT_THRESH = 'INPUT_THRESH'
+    INPUT_IOU_THRESH = 'INPUT_IOU_THRESH'
+
+    def initAlgorithm(self, config):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+
+        # The raw detections stored by Detect Trees
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT,
+                self.tr('Raw detections'),
+                extension='npz',
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.INPUT).setHelp(
+            'A detections_*.npz file, written by Detect Trees when raw detections are stored.')
+
+        # Add threshold parameter for algorithm
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_THRESH,
+                self.tr('Tree detection threshold'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                optional=True,
+                minValue=0.0,
+                maxValue=1.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_THRESH).setHelp(
+            'Below this value, a detected object will not be classified as a tree. ' +
+            'Values below the score the detections were stored down to have no effect. ' +
+            'Defaults to 0.5')
+
+        # Add overlap threshold parameter for algorithm
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INPUT_IOU_THRESH,
+                self.tr('Overlap detection threshold'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.4,
+                optional=True,
+                minValue=0.0,
+                maxValue=1.0,
+            )
+        )
+        self.parameterDefinition(self.INPUT_IOU_THRESH).setHelp(
+            'Boxes that overlap a box with a higher score with an intersection over union above this value ' +
+            'are considered the same tree and removed, also across slices. ' +
+            'Defaults to 0.4')
+
+        # Output parameter is a folder on the users computer
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.OUTPUT,
+                self.tr('Output folder'),
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.OUTPUT).setHelp(
+            'The generated GeoJSON will be placed in this folder after processing. ' +
+            'Make sure this folder is writable.')
+
+    def processAlgorithm(self, parameters, context, feedback):
+        raw_file_path = self.parameterAsFile(parameters, self.INPUT, context)
+        dest_folder = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        i_thresh = self.parameterAsDouble(parameters, self.INPUT_THRESH, context)
+        i_iou_thresh = self.parameterAsDouble(parameters, self.INPUT_IOU_THRESH, context)
+
+        columns, meta = load_raw_detections(raw_file_path)
+        feedback.pushInfo('Loaded {} raw detections, stored down to score {}'
+                          .format(len(columns['slice']), meta['floor']))
+        if i_thresh < meta['floor']:
+            feedback.pushInfo('The threshold is below the stored floor, trees between {} and {} are missing'
+                              .format(i_thresh, meta['floor']))
+
+        rows = refilter(columns, i_thresh, i_iou_thresh)
+        feedback.pushInfo('{} trees left with score >= {} and overlap <= {}'
+                          .format(len(rows), i_thresh, i_iou_thresh))
+
+        # write to file
+        current_datetime = datetime.datetime.now()
+        time_str = current_datetime.strftime("%Y-%m-%d_%H%M")
+        output_file_name = 'trees_{ts}.geojson'.format(ts=time_str)
+        output_file_path = '{df}/{fn}'.format(df=dest_folder, fn=output_file_name)
+        settings_file_path = '{df}/settings_{ts}.json'.format(df=dest_folder, ts=time_str)
+
+        write_geojson(output_file_path, columns, meta['crs'], rows)
+
+        with open(settings_file_path, 'wt') as out_file:
+            settings = dict(meta['detector'])
+            settings['filename'] = output_file_name
+            settings['raw_detections'] = raw_file_path
+            settings['refilter'] = {
+                'thresh': i_thresh,
+                'iou_threshold': i_iou_thresh,
+                'raw_boxes': len(columns['slice']),
+            }
+            settings['total_trees'] = len(rows)
+            out_file.write(json.dumps(settings, indent=1))
+
+        feedback.pushInfo('Written {}'.format(output_file_path))
+
+        return {self.OUTPUT: None}
+
+    def icon(self):
+        return QIcon(':/plugins/deepforestplugin/icon.png')
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        """
+        return 'Refilter Trees'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr(self.name())
+
+    def group(self):
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr(self.groupId())
+
+    def groupId(self):
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        """
+        return ''
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return DeepForestPluginRefilterAlgorithm()
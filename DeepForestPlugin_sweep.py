@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import datetime
+import json
+import re
+from .DeepForestPlugin_detections import load_raw_detections, sweep
+from .DeepForestPlugin_writers import write_geojson
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import (QgsProcessingAlgorithm,
+                       QgsProcessingException,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFolderDestination,
+                       QgsProcessingParameterString)
+
+
+def value_label(value):
+    """
+    How a threshold appears in the file names.
+    """
+    return '{:g}'.format(value)
+
+
+def parse_floats(text):
+    """
+    The numbers in a comma or space separated list, in order, without
+    duplicates. Raises QgsProcessingException for anything that is not a
+    number, and for numbers that would get the same file name.
+    """
+    values = []
+    labels = {}
+    for part in re.split(r'[,;\s]+', text or ''):
+        if not part:
+            continue
+        try:
+            value = float(part)
+        except ValueError:
+            raise QgsProcessingException('Not a number: {}'.format(part))
+        if value in values:
+            continue
+        if value_label(value) in labels:
+            raise QgsProcessingException('{} and {} are too close, their results would get the same file name'
+                                         .format(labels[value_label(value)], part))
+        labels[value_label(value)] = part
+        values.append(value)
+    return values
+
+
+class DeepForestPluginSweepAlgorithm(QgsProcessingAlgorithm):
+    """
+    Applies every combination of a list of score thresholds and a list of
+    overlap thresholds to the raw detections stored by the Detect Trees
+    algorithm, and writes one layer and the tree count per combination.
+    """
+
+    OUTPUT = 'OUTPUT'
+    INPUT = 'INPUT'
+    INPUT_THRESHOLDS = 'INPUT_THRESHOLDS'
+    INPUT_IOU_THRESHOLDS = 'INPUT_IOU_THRESHOLDS'
+
+    def initAlgorithm(self, config):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+
+        # The raw detections stored by Detect Trees
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT,
+                self.tr('Raw detections'),
+                extension='npz',
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.INPUT).setHelp(
+            'A detections_*.npz file, written by Detect Trees when raw detections are stored.')
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.INPUT_THRESHOLDS,
+                self.tr('Tree detection thresholds'),
+                defaultValue='0.3, 0.4, 0.5, 0.6, 0.7',
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.INPUT_THRESHOLDS).setHelp(
+            'Score thresholds to try, separated by commas. ' +
+            'Defaults to 0.3, 0.4, 0.5, 0.6, 0.7')
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.INPUT_IOU_THRESHOLDS,
+                self.tr('Overlap detection thresholds'),
+                defaultValue='0.2, 0.4, 0.6',
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.INPUT_IOU_THRESHOLDS).setHelp(
+            'Intersection over union thresholds to try, separated by commas. ' +
+            'Defaults to 0.2, 0.4, 0.6')
+
+        # Output parameter is a folder on the users computer
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.OUTPUT,
+                self.tr('Output folder'),
+                optional=False,
+            )
+        )
+        self.parameterDefinition(self.OUTPUT).setHelp(
+            'A GeoJSON per combination and a sweep_*.json with the tree counts will be placed in this folder. ' +
+            'Make sure this folder is writable.')
+
+    def processAlgorithm(self, parameters, context, feedback):
+        raw_file_path = self.parameterAsFile(parameters, self.INPUT, context)
+        dest_folder = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        i_thresholds = parse_floats(self.parameterAsString(parameters, self.INPUT_THRESHOLDS, context))
+        i_iou_thresholds = parse_floats(self.parameterAsString(parameters, self.INPUT_IOU_THRESHOLDS, context))
+
+        columns, meta = load_raw_detections(raw_file_path)
+        feedback.pushInfo('Loaded {} raw detections, stored down to score {}'
+                          .format(len(columns['slice']), meta['floor']))
+        if i_thresholds and min(i_thresholds) < meta['floor']:
+            feedback.pushInfo('Thresholds below the stored floor of {} miss the trees under it'
+                              .format(meta['floor']))
+
+        current_datetime = datetime.datetime.now()
+        time_str = current_datetime.strftime("%Y-%m-%d_%H%M")
+        combinations = len(i_thresholds) * len(i_iou_thresholds)
+        results = []
+        for thresh, iou_threshold, rows in sweep(columns, i_thresholds, i_iou_thresholds):
+            if feedback.isCanceled():
+                break
+            output_file_name = 'trees_{ts}_t{t}_iou{i}.geojson'.format(ts=time_str, t=value_label(thresh),
+                                                                    i=value_label(iou_threshold))
+            write_geojson('{df}/{fn}'.format(df=dest_folder, fn=output_file_name), columns, meta['crs'], rows)
+            scores = columns['score'][rows]
+            results.append({
+                'thresh': thresh,
+                'iou_threshold': iou_threshold,
+                'total_trees': len(rows),
+                'slices_with_trees': len(set(columns['slice'][rows].tolist())),
+                'mean_score': round(float(scores.mean()), 4) if len(rows) else None,
+                'filename': output_file_name,
+            })
+            feedback.pushInfo('score >= {}, overlap <= {}: {} trees'.format(thresh, iou_threshold, len(rows)))
+            feedback.setProgress(int(len(results) / combinations * 100))
+
+        sweep_file_path = '{df}/sweep_{ts}.json'.format(df=dest_folder, ts=time_str)
+        with open(sweep_file_path, 'wt') as out_file:
+            out_file.write(json.dumps({
+                'raw_detections': raw_file_path,
+                'raw_boxes': len(columns['slice']),
+                'detector': meta['detector'],
+                'combinations': results,
+            }, indent=1))
+
+        feedback.pushInfo('Written {}'.format(sweep_file_path))
+
+        return {self.OUTPUT: None}
+
+    def icon(self):
+        return QIcon(':/plugins/deepforestplugin/icon.png')
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        """
+        return 'Sweep Tree Thresholds'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr(self.name())
+
+    def group(self):
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr(self.groupId())
+
+    def groupId(self):
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        """
+        return ''
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return DeepForestPluginSweepAlgorithm()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ DeepForestPlugin
+                                 A QGIS plugin
+ Plugin using DeepForest to detect trees
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2023-02-21
+        copyright            : (C) 2023 by PXL Smart ICT
+        email                : servaas.tilkin@pxl.be
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'PXL Smart ICT'
+__date__ = '2023-02-21'
+__copyright__ = '(C) 2023 by PXL Smart ICT'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+
+import numpy as np
+
+from .DeepForestPlugin_detections import columns_to_features, concat_columns, polygon_corners
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsFeature, QgsFeatureSink, QgsField, QgsFields, QgsGeometry, QgsPointXY
+
+# features are written without the whitespace json.dumps adds by default
+COMPACT = (',', ':')
+
+
+class GeoJsonWriter(object):
+    """
+    Writes features to disk as they come in, instead of building the whole
+    document in memory. By default the output is a GeoJSON
+    FeatureCollection with a feature per line. With seq=True it is
+    newline-delimited GeoJSONSeq (GeoJSONL): every line is a complete
+    feature, flushed after every write, so other tools can follow the file
+    while it grows. GeoJSONSeq has no crs member, readers assume WGS 84
+    unless told otherwise.
+    """
+
+    def __init__(self, path, crs, seq=False):
+        self.path = path
+        self.crs = crs
+        self.seq = seq
+        self.count = 0
+        self._file = open(path, 'wt')
+        if not seq:
+            self._file.write(json.dumps({
+                'type': 'FeatureCollection',
+                'crs': {
+                    'type': 'name',
+                    'properties': {
+                        'name': crs
+                    }
+                }
+            }, separators=COMPACT)[:-1] + ',"features":[')
+
+    def write(self, columns, rows=None):
+        """
+        Appends the features of the given rows of the columns (all rows
+        when None) and returns how many were written.
+        """
+        features = columns_to_features(columns, rows)
+        if not features:
+            return 0
+        lines = [json.dumps(feature, separators=COMPACT) for feature in features]
+        if self.seq:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+        else:
+            self._file.write((',\n' if self.count else '\n') + ',\n'.join(lines))
+        self.count = self.count + len(features)
+        return len(features)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if not self.seq:
+            self._file.write('\n]}\n')
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def polygon_wkb(corner_x, corner_y):
+    """
+    The little-endian WKB of a polygon per row of the (n, 4) corner arrays,
+    as one buffer of fixed size records.
+    """
+    record = np.dtype([('order', 'u1'), ('type', '<u4'), ('rings', '<u4'), ('points', '<u4'),
+                       ('xy', '<f8', (5, 2))])
+    wkb = np.zeros(len(corner_x), dtype=record)
+    wkb['order'] = 1
+    wkb['type'] = 3  # Polygon
+    wkb['rings'] = 1
+    wkb['points'] = 5
+    wkb['xy'][:, :4, 0] = corner_x
+    wkb['xy'][:, :4, 1] = corner_y
+    wkb['xy'][:, 4] = wkb['xy'][:, 0]
+    return wkb.tobytes(), record.itemsize
+
+
+class GeoParquetWriter(object):
+    """
+    Writes the trees as GeoParquet, for loading into columnar engines. The
+    columns are built straight from the box arrays: the polygon as WKB, its
+    bounding box and centroid in map coordinates, score, label, slice and
+    tree. Rows are buffered until there are enough for a row group, so
+    row groups are written as slices finish without being tiny.
+
+    Needs pyarrow, which is imported here so the other outputs work
+    without it. crs is the PROJJSON of the raster CRS, or None when it is
+    unknown.
+    """
+
+    ROW_GROUP = 64 * 1024
+
+    def __init__(self, path, crs):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.count = 0
+        self._pa = pa
+        self._pending = []
+        self._pending_rows = 0
+        bbox = pa.struct([('xmin', pa.float64()), ('ymin', pa.float64()),
+                          ('xmax', pa.float64()), ('ymax', pa.float64())])
+        geo = {
+            'version': '1.1.0',
+            'primary_column': 'geometry',
+            'columns': {
+                'geometry': {
+                    'encoding': 'WKB',
+                    'geometry_types': ['Polygon'],
+                    'crs': crs,
+                    'covering': {'bbox': {name: ['bbox', name] for name in ('xmin', 'ymin', 'xmax', 'ymax')}},
+                }
+            }
+        }
+        self._schema = pa.schema([('slice', pa.int64()), ('tree', pa.int64()),
+                                  ('score', pa.float64()), ('label', pa.string()),
+                                  ('centroid_x', pa.float64()), ('centroid_y', pa.float64()),
+                                  ('bbox', bbox), ('geometry', pa.binary())],
+                                 metadata={'geo': json.dumps(geo)})
+        self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, columns):
+        """
+        Adds all rows of the columns and returns how many were added.
+        """
+        total = len(columns['slice'])
+        if total == 0:
+            return 0
+        self._pending.append(columns)
+        self._pending_rows = self._pending_rows + total
+        self.count = self.count + total
+        if self._pending_rows >= self.ROW_GROUP:
+            self._flush()
+        return total
+
+    def _flush(self):
+        if not self._pending_rows:
+            return
+        pa = self._pa
+        columns = concat_columns(self._pending)
+        self._pending = []
+        self._pending_rows = 0
+        total = len(columns['slice'])
+        corner_x, corner_y = polygon_corners(columns)
+        wkb, size = polygon_wkb(corner_x, corner_y)
+        offsets = np.arange(total + 1, dtype=np.int32) * size
+        geometry = pa.Array.from_buffers(pa.binary(), total, [None, pa.py_buffer(offsets), pa.py_buffer(wkb)])
+        bbox = pa.StructArray.from_arrays(
+            [corner_x.min(axis=1), corner_y.min(axis=1), corner_x.max(axis=1), corner_y.max(axis=1)],
+            names=['xmin', 'ymin', 'xmax', 'ymax'])
+        table = pa.Table.from_arrays([
+            columns['slice'].astype(np.int64), columns['tree'].astype(np.int64),
+            columns['score'].astype(np.float64), pa.array(columns['label'].astype(str)),
+            corner_x.mean(axis=1), corner_y.mean(axis=1), bbox, geometry], schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._flush()
+        self._writer.close()
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FeatureSinkWriter(object):
+    """
+    Adds the trees to a Processing feature sink, e.g. a GeoPackage or
+    FlatGeobuf layer, with the same attributes as the GeoJSON output.
+    Features are added in batches with FastInsert, so the provider can
+    write them in one transaction.
+    """
+
+    # attribute name, type and the column it comes from, in the order of the fields
+    ATTRIBUTES = [('slice', QVariant.Int), ('tree', QVariant.Int),
+                  ('xg_0', QVariant.Double), ('xg_1', QVariant.Double),
+                  ('yg_0', QVariant.Double), ('yg_1', QVariant.Double),
+                  ('xmin', QVariant.Double), ('ymin', QVariant.Double),
+                  ('xmax', QVariant.Double), ('ymax', QVariant.Double),
+                  ('label', QVariant.String), ('score', QVariant.Double)]
+    BATCH = 10000
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.count = 0
+
+    @classmethod
+    def fields(cls):
+        fields = QgsFields()
+        for name, field_type in cls.ATTRIBUTES:
+            fields.append(QgsField(name, field_type))
+        return fields
+
+    def write(self, columns):
+        """
+        Adds the features of all rows of the columns and returns how many
+        were added.
+        """
+        total = len(columns['slice'])
+        if total == 0:
+            return 0
+        fields = self.fields()
+        corner_x, corner_y = polygon_corners(columns)
+        corner_x, corner_y = corner_x.tolist(), corner_y.tolist()
+        values = [columns[name].tolist() if name != 'label' else [str(label) for label in columns[name]]
+                  for name, _ in self.ATTRIBUTES]
+        for start in range(0, total, self.BATCH):
+            features = []
+            for row in range(start, min(total, start + self.BATCH)):
+                feature = QgsFeature(fields)
+                ring = [QgsPointXY(x, y) for x, y in zip(corner_x[row], corner_y[row])]
+                feature.setGeometry(QgsGeometry.fromPolygonXY([ring + ring[:1]]))
+                feature.setAttributes([column[row] for column in values])
+                features.append(feature)
+            self.sink.addFeatures(features, QgsFeatureSink.FastInsert)
+        self.count = self.count + total
+        return total
+
+
+def write_geojson(path, columns, crs, rows=None):
+    """
+    Writes the given rows of the columns (all rows when None) as a GeoJSON
+    FeatureCollection in the given crs and returns the number of features.
+    """
+    with GeoJsonWriter(path, crs) as writer:
+        return writer.write(columns, rows)
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the DeepForestPlugin processing pipeline.
+
+These run outside of QGIS; only numpy, Pillow, requests and the GDAL
+python bindings are needed. Usage:
+
+    python scripts/benchmark.py read [--size 12000] [--slice 3500]
+    python scripts/benchmark.py codecs [--raster ortho.tif] [--url http://host:5000/]
+    python scripts/benchmark.py transport [--tiles 2000] [--latency 0.05] [--url http://host:5000/]
+    python scripts/benchmark.py endpoints [--tiles 600] [--transport asyncio]
+    python scripts/benchmark.py dedup [--boxes 10000 100000 1000000] [--reference-max 10000]
+"""
+
+import argparse
+import importlib
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import requests
+from osgeo import gdal
+
+from standin_server import StandInServer
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'deepforestplugin'
+
+
+def plugin_module(name):
+    """
+    Imports a module of the plugin without needing QGIS on the path.
+    """
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(PACKAGE, os.path.join(PLUGIN_DIR, '__init__.py'),
+                                                      submodule_search_locations=[PLUGIN_DIR])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE] = package
+        spec.loader.exec_module(package)
+    return importlib.import_module('{}.{}'.format(PACKAGE, name))
+
+
+def synthetic_rgb(height, width, seed=0):
+    """
+    Smooth noise that compresses roughly like an orthomosaic would.
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    return np.repeat(np.repeat(small, 16, axis=0), 16, axis=1)[:height, :width]
+
+
+def write_geotiff(path, rgb, options):
+    height, width = rgb.shape[:2]
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, width, height, 3, gdal.GDT_Byte, options=options)
+    for b in range(3):
+        ds.GetRasterBand(b + 1).WriteArray(rgb[:, :, b])
+    ds.FlushCache()
+    ds = None
+
+
+def bench_read(args):
+    reader_module = plugin_module('DeepForestPlugin_reader')
+    rgb = synthetic_rgb(args.size, args.size)
+    layouts = {
+        'tiled': ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE'],
+        'striped': ['TILED=NO', 'COMPRESS=DEFLATE'],
+    }
+
+    print('{:<10}{:<10}{:>8}{:>12}{:>10}'.format('layout', 'grid', 'parts', 'seconds', 'MB/s'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for layout, options in layouts.items():
+            path = os.path.join(tmp_dir, layout + '.tif')
+            write_geotiff(path, rgb, options)
+            for aligned in (False, True):
+                gdal.SetCacheMax(64 * 1024 * 1024)
+                ds = gdal.Open(path)
+                reader = reader_module.TileReader(ds, args.slice, block_aligned=aligned)
+                read_bytes = 0
+                start = time.perf_counter()
+                for tile in reader.tiles():
+                    read_bytes = read_bytes + reader.read(tile).nbytes
+                elapsed = time.perf_counter() - start
+                ds = None
+                print('{:<10}{:<10}{:>8}{:>12.3f}{:>10.1f}'.format(
+                    layout, 'block' if aligned else 'plain', reader.total_parts,
+                    elapsed, read_bytes / elapsed / 1e6))
+
+
+def sample_tiles(args, reader_module):
+    """
+    Up to args.tiles slices of args.raster, or synthetic slices without one.
+    """
+    if args.raster is None:
+        return [synthetic_rgb(args.slice, args.slice, seed) for seed in range(args.tiles)]
+    reader = reader_module.TileReader(gdal.Open(args.raster), args.slice, reuse_buffer=False)
+    return [reader.read(tile) for tile, _ in zip(reader.tiles(), range(args.tiles))]
+
+
+def detect(session, url, codec, rgb, data=None):
+    data = codec.encode(rgb) if data is None else data
+    files = {'file': ('part.' + codec.extension, data, codec.mime_type)}
+    resp = session.post(url + 'tree_rects', files=files, cookies={'session': 'deepforest_plugin'})
+    resp.raise_for_status()
+    boxes = resp.json()
+    return np.array([[b['xmin'], b['ymin'], b['xmax'], b['ymax']] for b in boxes], dtype=float).reshape(-1, 4)
+
+
+def matched_fraction(reference, boxes, iou_thresh=0.5):
+    """
+    Fraction of reference boxes that have a box with IoU >= iou_thresh.
+    """
+    if len(reference) == 0:
+        return 1.0 if len(boxes) == 0 else 0.0
+    if len(boxes) == 0:
+        return 0.0
+    ix = np.minimum(reference[:, None, 2], boxes[None, :, 2]) - np.maximum(reference[:, None, 0], boxes[None, :, 0])
+    iy = np.minimum(reference[:, None, 3], boxes[None, :, 3]) - np.maximum(reference[:, None, 1], boxes[None, :, 1])
+    inter = np.clip(ix, 0, None) * np.clip(iy, 0, None)
+    area_r = (reference[:, 2] - reference[:, 0]) * (reference[:, 3] - reference[:, 1])
+    area_b = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    iou = inter / (area_r[:, None] + area_b[None, :] - inter)
+    return float(np.mean(iou.max(axis=1) >= iou_thresh))
+
+
+def bench_codecs(args):
+    reader_module = plugin_module('DeepForestPlugin_reader')
+    codecs = plugin_module('DeepForestPlugin_codecs')
+    tiles = sample_tiles(args, reader_module)
+    configs = [
+        ('PNG', 90, False),  # lossless reference
+        ('JPEG', 90, True),
+        ('JPEG', 90, False),
+        ('JPEG', 75, False),
+        ('WebP', 90, False),
+        ('WebP', 90, True),
+        ('Raw uint8', 90, False),
+        ('NPY', 90, False),
+    ]
+
+    session = requests.Session()
+    reference = None
+    print('{:<22}{:>12}{:>14}{:>10}{:>10}'.format('codec', 'ms/tile', 'KB/tile', 'trees', 'agree'))
+    for name, quality, optimize in configs:
+        codec = codecs.make_codec(name, quality=quality, optimize=optimize)
+        start = time.perf_counter()
+        encoded = [codec.encode(rgb) for rgb in tiles]
+        elapsed = time.perf_counter() - start
+        size = sum(len(data) for data in encoded)
+
+        trees, agree = '-', '-'
+        if args.url is not None:
+            results = [detect(session, args.url, codec, rgb, data) for rgb, data in zip(tiles, encoded)]
+            if reference is None:
+                reference = results
+            trees = sum(len(boxes) for boxes in results)
+            agree = '{:.3f}'.format(np.mean([matched_fraction(ref, boxes) for ref, boxes in zip(reference, results)]))
+
+        label = '{} q{}{}'.format(name, quality, ' opt' if optimize else '') if not codec.lossless else name
+        print('{:<22}{:>12.1f}{:>14.1f}{:>10}{:>10}'.format(
+            label, elapsed / len(tiles) * 1000, size / len(tiles) / 1024, trees, agree))
+
+
+def bench_transport(args):
+    client_module = plugin_module('DeepForestPlugin_client')
+    pipeline = plugin_module('DeepForestPlugin_pipeline')
+    server = None
+    url = args.url
+    if url is None:
+        server = StandInServer(latency=args.latency, jitter=args.latency / 2).start()
+        url = server.url
+    data = os.urandom(args.kbytes * 1024)
+    tiles = range(args.tiles)
+
+    def not_canceled():
+        return False
+
+    print('{:<10}{:>12}{:>12}{:>12}{:>10}'.format('transport', 'concurrency', 'seconds', 'tiles/s', 'errors'))
+    for concurrency in args.concurrency:
+        for transport in ('Threads', 'asyncio'):
+            if transport == 'asyncio':
+                client = client_module.AsyncTreeDetectorClient(url, max_in_flight=concurrency)
+                results = pipeline.run_ordered(None, tiles, concurrency, not_canceled, submit=lambda tile: client.submit(
+                    client.tree_rects_async('part_{}.jpg'.format(tile), data, 'image/jpeg')))
+            else:
+                client = client_module.TreeDetectorClient(url, pool_size=concurrency)
+                results = pipeline.run_ordered(lambda tile: client.tree_rects('part_{}.jpg'.format(tile), data,
+                                                                              'image/jpeg'),
+                                               tiles, concurrency, not_canceled)
+            start = time.perf_counter()
+            errors = sum(1 for _, future in results if future.exception() is not None)
+            elapsed = time.perf_counter() - start
+            client.close()
+            print('{:<10}{:>12}{:>12.2f}{:>12.1f}{:>10}'.format(
+                transport, concurrency, elapsed, args.tiles / elapsed, errors))
+    if server is not None:
+        server.stop()
+
+
+def bench_endpoints(args):
+    """
+    Spreads a job over three local stand-in servers: a fast one, a slow
+    one and one that fails half of its requests until halfway the job.
+    """
+    client_module = plugin_module('DeepForestPlugin_client')
+    pipeline = plugin_module('DeepForestPlugin_pipeline')
+    servers = {
+        'fast': StandInServer(latency=args.latency).start(),
+        'slow': StandInServer(latency=args.latency * 8).start(),
+        'flaky': StandInServer(latency=args.latency, fail=0.5).start(),
+    }
+    urls = [server.url for server in servers.values()]
+    if args.transport == 'asyncio':
+        client = client_module.AsyncTreeDetectorClient(urls, max_in_flight=args.concurrency)
+    else:
+        client = client_module.TreeDetectorClient(urls, pool_size=args.concurrency)
+    client.endpoints.cooldown = args.cooldown
+    data = os.urandom(16 * 1024)
+
+    def detect(tile):
+        if tile == args.tiles // 2:
+            servers['flaky'].config['fail'] = 0.0
+        return client.tree_rects('part_{}.jpg'.format(tile), data, 'image/jpeg')
+
+    start = time.perf_counter()
+    errors = 0
+    for _, future in pipeline.run_ordered(detect, range(args.tiles), args.concurrency, lambda: False):
+        errors = errors + (future.exception() is not None)
+        for event in client.endpoints.drain_events():
+            print('  {:.1f}s {}'.format(time.perf_counter() - start, event))
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    print('{} tiles in {:.2f}s, {} lost'.format(args.tiles, elapsed, errors))
+    print('{:<8}{:>10}{:>10}{:>10}{:>10}'.format('server', 'requests', 'failures', 'removals', 'latency'))
+    for (name, server), endpoint in zip(servers.items(), client.endpoints.summary()):
+        print('{:<8}{:>10}{:>10}{:>10}{:>10}'.format(name, endpoint['requests'], endpoint['failures'],
+                                                    endpoint['removals'], endpoint['latency_seconds']))
+        server.stop()
+
+
+def overlap(rect_1, rect_2):
+    # the duplicate rule as it was in DeepForestPlugin_algorithm.py, as a reference
+    r1_right = max(rect_1['xg_0'], rect_1['xg_1'])
+    r1_left = min(rect_1['xg_0'], rect_1['xg_1'])
+    r1_top = max(rect_1['yg_0'], rect_1['yg_1'])
+    r1_bottom = min(rect_1['yg_0'], rect_1['yg_1'])
+
+    r1_mx = (r1_left + r1_right) / 2
+    r1_my = (r1_bottom + r1_top) / 2
+
+    r2_right = max(rect_2['xg_0'], rect_2['xg_1'])
+    r2_left = min(rect_2['xg_0'], rect_2['xg_1'])
+    r2_top = max(rect_2['yg_0'], rect_2['yg_1'])
+    r2_bottom = min(rect_2['yg_0'], rect_2['yg_1'])
+
+    r2_mx = (r2_left + r2_right) / 2
+    r2_my = (r2_bottom + r2_top) / 2
+
+    if r1_left <= r2_mx <= r1_right and r1_bottom <= r2_my <= r1_top:
+        return True
+    if r2_left <= r1_mx <= r2_right and r2_bottom <= r1_my <= r2_top:
+        return True
+
+    return False
+
+
+def get_area(rect_1):
+    r1_right = max(rect_1['xg_0'], rect_1['xg_1'])
+    r1_left = min(rect_1['xg_0'], rect_1['xg_1'])
+    r1_top = max(rect_1['yg_0'], rect_1['yg_1'])
+    r1_bottom = min(rect_1['yg_0'], rect_1['yg_1'])
+
+    return (r1_right - r1_left) * (r1_top - r1_bottom)
+
+
+def reference_dedup(feature_list):
+    dupe_count = 0
+    idx_1 = 0
+    while idx_1 < len(feature_list):
+        idx_2 = idx_1 + 1  # starting index
+        while idx_2 < len(feature_list):
+            if overlap(feature_list[idx_1]['properties'],
+                       feature_list[idx_2]['properties']):
+                dupe_count = dupe_count + 1
+                # delete smallest of the two rectangles
+                area_r1 = get_area(feature_list[idx_1]['properties'])
+                area_r2 = get_area(feature_list[idx_2]['properties'])
+                if area_r1 > area_r2:
+                    feature_list.pop(idx_2)
+                    idx_2 = idx_2 - 1  # this index now points to another item -> check again
+                    if idx_2 < 0 or idx_2 >= len(feature_list):
+                        break
+                else:
+                    feature_list.pop(idx_1)
+                    idx_1 = idx_1 - 1  # this index now points to another item -> check again
+                    if idx_1 < 0 or idx_1 >= len(feature_list):
+                        break
+            idx_2 = idx_2 + 1
+        idx_1 = idx_1 + 1
+    return feature_list, dupe_count
+
+
+def synthetic_trees(count, seed=0):
+    """
+    Tree features in slice order, about one per 400 m², 3 to 12 m wide,
+    with a tenth of them found a second time, slightly shifted, in the
+    next slice as happens along the slice seams.
+    """
+    rng = np.random.default_rng(seed)
+    originals = int(count / 1.1)
+    side = np.sqrt(originals * 400.0)
+    x = rng.uniform(0, side, count)
+    y = rng.uniform(0, side, count)
+    size = rng.uniform(3, 12, count)
+    seams = np.arange(originals, count)
+    source = rng.integers(0, originals, len(seams))
+    x[seams] = x[source] + rng.normal(0, 0.5, len(seams))
+    y[seams] = y[source] + rng.normal(0, 0.5, len(seams))
+    size[seams] = size[source] * rng.uniform(0.8, 1.2, len(seams))
+    slices = np.floor(x / 500) + np.floor(y / 500) * 1000
+    slices[seams] = slices[source] + 1
+    order = np.argsort(slices, kind='stable')
+    return [{'properties': {'id': int(i), 'xg_0': float(x[i]), 'xg_1': float(x[i] + size[i]),
+                            'yg_0': float(y[i] + size[i]), 'yg_1': float(y[i])}} for i in order]
+
+
+def bench_dedup(args):
+    """
+    Time of the grid based duplicate removal against the pairwise loop it
+    replaced, and whether both keep exactly the same trees.
+    """
+    detections = plugin_module('DeepForestPlugin_detections')
+    print('{:>9}{:>12}{:>12}{:>10}{:>10}  {}'.format('boxes', 'pairwise s', 'grid s', 'speedup', 'removed',
+                                                     'identical'))
+    for count in args.boxes:
+        features = synthetic_trees(count)
+
+        start = time.perf_counter()
+        keep, dupe_count = detections.overlap_duplicates(
+            np.array([feature['properties']['xg_0'] for feature in features], dtype=np.float64),
+            np.array([feature['properties']['yg_0'] for feature in features], dtype=np.float64),
+            np.array([feature['properties']['xg_1'] for feature in features], dtype=np.float64),
+            np.array([feature['properties']['yg_1'] for feature in features], dtype=np.float64))
+        kept = [feature for feature, k in zip(features, keep.tolist()) if k]
+        grid_time = time.perf_counter() - start
+
+        if count <= args.reference_max:
+            start = time.perf_counter()
+            reference, reference_count = reference_dedup(list(features))
+            reference_time = time.perf_counter() - start
+            identical = (reference_count == dupe_count and
+                         [f['properties']['id'] for f in reference] == [f['properties']['id'] for f in kept])
+            print('{:>9}{:>12.2f}{:>12.3f}{:>9.0f}x{:>10}  {}'.format(count, reference_time, grid_time,
+                                                                      reference_time / grid_time, dupe_count,
+                                                                      'yes' if identical else 'NO'))
+        else:
+            print('{:>9}{:>12}{:>12.3f}{:>10}{:>10}  {}'.format(count, '-', grid_time, '-', dupe_count,
+                                                                '(pairwise skipped)'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    read_parser = commands.add_parser('read', help='slice read throughput on tiled vs striped GeoTIFFs')
+    read_parser.add_argument('--size', type=int, default=12000, help='raster width and height in pixels')
+    read_parser.add_argument('--slice', type=int, default=3500, help='tile slicing size')
+    read_parser.set_defaults(func=bench_read)
+
+    codecs_parser = commands.add_parser('codecs', help='encode time, size and detection agreement per codec')
+    codecs_parser.add_argument('--raster', help='raster to take slices from (synthetic slices without one)')
+    codecs_parser.add_argument('--url', help='tree detector base url, to measure detection agreement')
+    codecs_parser.add_argument('--slice', type=int, default=3500, help='tile slicing size')
+    codecs_parser.add_argument('--tiles', type=int, default=4, help='number of slices to encode')
+    codecs_parser.set_defaults(func=bench_codecs)
+
+    transport_parser = commands.add_parser('transport', help='threaded vs asyncio requests to the detector')
+    transport_parser.add_argument('--url', help='tree detector base url (a local stand-in server without one)')
+    transport_parser.add_argument('--tiles', type=int, default=2000, help='number of requests')
+    transport_parser.add_argument('--kbytes', type=int, default=64, help='size of every upload')
+    transport_parser.add_argument('--latency', type=float, default=0.05, help='stand-in server latency, seconds')
+    transport_parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32, 128],
+                                  help='requests in flight')
+    transport_parser.set_defaults(func=bench_transport)
+
+    endpoints_parser = commands.add_parser('endpoints', help='load balancing over fast, slow and flaky servers')
+    endpoints_parser.add_argument('--tiles', type=int, default=600, help='number of requests')
+    endpoints_parser.add_argument('--latency', type=float, default=0.05, help='fast server latency, seconds')
+    endpoints_parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    endpoints_parser.add_argument('--cooldown', type=float, default=1.0, help='seconds a removed server sits out')
+    endpoints_parser.add_argument('--transport', choices=['Threads', 'asyncio'], default='Threads')
+    endpoints_parser.set_defaults(func=bench_endpoints)
+
+    dedup_parser = commands.add_parser('dedup', help='grid based vs pairwise duplicate tree removal')
+    dedup_parser.add_argument('--boxes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                              help='numbers of boxes')
+    dedup_parser.add_argument('--reference-max', type=int, default=10000,
+                              help='largest number of boxes to also run the pairwise loop on, it is quadratic')
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in for the DeepForest web service, for benchmarks and trying the
+plugin without a GPU server. It answers the same endpoints with made up
+boxes after a configurable delay, and can be told to fail or hang on a
+fraction of the requests. Usage:
+
+    python scripts/standin_server.py [--port 5000] [--latency 0.2] [--fail 0.0]
+"""
+
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        config = self.server.config
+        with self.server.lock:
+            self.server.requests = self.server.requests + 1
+            roll = self.server.random.random()
+
+        time.sleep(max(0.0, config['latency'] + self.server.random.uniform(-1, 1) * config['jitter']))
+        if roll < config['hang']:
+            time.sleep(config['hang_seconds'])
+        if roll < config['fail']:
+            self._reply(503, {'error': 'stand-in failure'})
+        elif self.path.endswith('/settings'):
+            self._reply(200, {})
+        elif self.path.endswith('/tree_rects'):
+            # only the uploaded file, the multipart boundary differs per request
+            self._reply(200, self.fake_boxes(self.form_parts(body)['file'], config['trees']))
+        elif self.path.endswith('/tree_rects_batch') and config['batch']:
+            parts = self.form_parts(body)
+            manifest = json.loads(parts['tiles'])
+            self._reply(200, {str(tile['id']): self.fake_boxes(parts[tile['file']], config['trees'])
+                              for tile in manifest})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_GET(self):
+        if self.path.endswith('/version'):
+            data = self.server.config['model'].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def form_parts(self, body):
+        """
+        The parts of a multipart/form-data body, by field name.
+        """
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('latin-1') + b'\r\n\r\n' + body)
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                for part in message.iter_parts()}
+
+    @staticmethod
+    def fake_boxes(body, count):
+        """
+        Boxes that only depend on the uploaded bytes, so runs are repeatable.
+        """
+        rng = random.Random(hashlib.sha1(body).hexdigest())
+        boxes = []
+        for _ in range(count):
+            x, y, size = rng.uniform(0, 3000), rng.uniform(0, 3000), rng.uniform(20, 120)
+            boxes.append({'xmin': x, 'ymin': y, 'xmax': x + size, 'ymax': y + size,
+                          'label': 'Tree', 'score': round(rng.uniform(0.3, 1.0), 3)})
+        return boxes
+
+    def _reply(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # many clients connect at once
+
+
+class StandInServer(object):
+    """
+    Runs a stand-in server on a background thread, e.g. for benchmarks.
+    """
+
+    def __init__(self, port=0, latency=0.2, jitter=0.0, fail=0.0, hang=0.0, hang_seconds=30.0, trees=20, seed=0,
+                 batch=True, model='stand-in 1.0'):
+        self.httpd = StandInHTTPServer(('127.0.0.1', port), StandInHandler)
+        self.httpd.config = {'latency': latency, 'jitter': jitter, 'fail': fail,
+                             'hang': hang, 'hang_seconds': hang_seconds, 'trees': trees, 'batch': batch,
+                             'model': model}
+        self.httpd.lock = threading.Lock()
+        self.httpd.random = random.Random(seed)
+        self.httpd.requests = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+
+    @property
+    def config(self):
+        return self.httpd.config
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra or less latency, in seconds')
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of requests that get a 503')
+    parser.add_argument('--hang', type=float, default=0.0, help='fraction of requests that hang')
+    parser.add_argument('--trees', type=int, default=20, help='boxes returned per slice')
+    parser.add_argument('--no-batch', action='store_true', help='answer tree_rects_batch with a 404')
+    args = parser.parse_args()
+
+    server = StandInServer(args.port, args.latency, args.jitter, args.fail, args.hang, trees=args.trees,
+                           batch=not args.no_batch)
+    print('Stand-in DeepForest server on {}'.format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()